@@ -6,3 +6,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "comments.settings")
 
 application = get_asgi_application()
+
+# Imported once Django is set up
+from user_comments.middleware import RequestBodyLimitMiddleware  # noqa: E402
+
+application = RequestBodyLimitMiddleware(application)
@@ -35,7 +35,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "user_comments.middleware.RequestTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "user_comments.middleware.CommentsGZipMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -65,6 +67,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "comments.wsgi.application"
+ASGI_APPLICATION = "comments.asgi.application"
 
 
 # Database
@@ -82,6 +85,83 @@ DATABASES = {
 }
 
 
+# Cache
+# Redis when REDIS_URL is set, process-local memory otherwise
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds a rendered comments page stays cached; writes invalidate it earlier
+COMMENTS_CACHE_TIMEOUT = 60 * 15
+
+# Per-request timings: a Server-Timing header on every response, and Prometheus metrics
+# at /metrics/ when COMMENTS_METRICS=1 (counted per worker process)
+COMMENTS_SERVER_TIMING = True
+COMMENTS_METRICS = os.environ.get('COMMENTS_METRICS') == '1'
+
+# One line per request on the "user_comments.requests" logger, next to the app's own errors
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'user_comments': {
+            'handlers': ['console'],
+            'level': os.environ.get('COMMENTS_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# Posts per page of the post listing
+COMMENTS_POSTS_PER_PAGE = 10
+
+# Where comment images are thumbnailed after the comment is saved:
+# 'thread' - in-process thread pool, 'inline' - right after commit (tests),
+# 'worker' - by a separate `manage.py process_images` process
+COMMENTS_IMAGE_PROCESSING = os.environ.get('COMMENTS_IMAGE_PROCESSING', 'thread')
+
+# Upload limits of the comment create endpoints, enforced while the body streams in
+COMMENTS_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+COMMENTS_MAX_IMAGE_SIZE = 5 * 1024 * 1024
+COMMENTS_MAX_IMAGE_PIXELS = 4096 * 4096
+COMMENTS_MAX_TEXT_FILE_SIZE = 100 * 1024
+
+# Pre-rendered CAPTCHAs kept by `manage.py fill_captcha_pool`; get_captcha falls back to
+# generating a key on the fly when the pool runs dry
+COMMENTS_CAPTCHA_POOL_SIZE = 500
+COMMENTS_CAPTCHA_POOL_LIFETIME = 60 * 60
+
+# Token buckets in front of the comment create endpoints, as (burst, tokens per second);
+# shared through Redis when REDIS_URL is set, per process otherwise
+COMMENTS_RATE_LIMITS = {
+    'ip': (10, 10 / 60),
+    'email': (5, 5 / 300),
+}
+
+# Reverse proxies in front of the app that append to X-Forwarded-For. The per-IP bucket is keyed
+# on the client address they report; with 0 it is REMOTE_ADDR, which behind a proxy (as on Render,
+# set COMMENTS_TRUSTED_PROXIES=1 there) is the proxy's and puts every client in one bucket
+COMMENTS_TRUSTED_PROXIES = int(os.environ.get('COMMENTS_TRUSTED_PROXIES', '0'))
+
+# Seconds within which the same text from the same e-mail under the same parent is a duplicate
+COMMENTS_DUPLICATE_WINDOW = 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -17,6 +17,42 @@ axios.interceptors.request.use(config => {
   return config;
 });
 
+// Replies shown inline under every comment; the rest are loaded when a thread is expanded
+const INLINE_REPLIES = 3;
+
+// Comment data is fetched as msgpack in the columnar layout when the decoder is loaded, JSON otherwise
+function getComments(url) {
+  if (!window.MessagePack) {
+    return axios.get(url);
+  }
+  const separator = url.includes('?') ? '&' : '?';
+  return axios.get(`${url}${separator}layout=columns`, {
+    responseType: 'arraybuffer',
+    headers: {'Accept': 'application/msgpack'},
+  }).then(response => {
+    response.data = MessagePack.decode(new Uint8Array(response.data));
+    response.data.comments = unflattenComments(response.data.comments);
+    return response;
+  });
+}
+
+// Rebuilds the nested tree from value rows and parent indices
+function unflattenComments(columns) {
+  const roots = [];
+  const nodes = columns.rows.map(values => {
+    const node = {children: []};
+    columns.fields.forEach((field, i) => {
+      node[field] = values[i];
+    });
+    return node;
+  });
+  nodes.forEach((node, i) => {
+    const parent = columns.parents[i];
+    (parent === -1 ? roots : nodes[parent].children).push(node);
+  });
+  return roots;
+}
+
 const Comment = {
   template: `
   <div class="comment-block">
@@ -34,7 +70,10 @@ const Comment = {
       <a :href="comment.text_file" download>Download</a>
     </p>
     </div>
-    <div v-if="comment.image">
+    <div v-if="comment.image && comment.image_status === 'processing'">
+      <p>The image is being processed...</p>
+    </div>
+    <div v-else-if="comment.image">
       <img :src="comment.image" alt="Image" @mouseover="imageHover(true)" @mouseout="imageHover(false)">
     </div>
     <button class="reply" @click="showReplyForm(comment)">Reply</button>
@@ -100,6 +139,9 @@ const Comment = {
         </li>
       </ul>
     </div>
+    <button v-if="comment.reply_count > comment.children.length" class="reply" type="button" @click="loadReplies()">
+      Show more replies ({{ comment.reply_count - comment.children.length }})
+    </button>
     </div>
   `,
   props: ['comment', 'comment_form', 'showCommentForm'],
@@ -136,6 +178,29 @@ const Comment = {
     updateComments() {
       this.$root.updateComments();
     },
+    loadReplies() {
+      const sortBy = this.$root.comment_form.sort_by;
+      let repliesURL = `/api/v1/comments/${this.comment.id}/replies/?cursor=${encodeURIComponent(this.comment.replies_cursor || '')}`;
+      if (sortBy) {
+        repliesURL += `&sort_by=${sortBy}&order=${this.$root.comment_form.order}`;
+      }
+      getComments(repliesURL)
+        .then(response => {
+          // Replies pushed live may already be shown
+          response.data.comments.forEach(reply => {
+            if (!this.comment.children.some(child => child.id === reply.id)) {
+              this.comment.children.push(reply);
+            }
+          });
+          this.comment.replies_cursor = response.data.next_cursor;
+          if (!response.data.next_cursor) {
+            this.comment.reply_count = this.comment.children.length;
+          }
+        })
+        .catch(error => {
+          console.error('Error loading replies:', error);
+        });
+    },
     imageHover(shouldEnlarge) {
       const imageElement = document.querySelector('.comment img');
       if (shouldEnlarge) {
@@ -209,7 +274,11 @@ const Comment = {
       axios.post(postURL, formData, config)
         .then(response => {
           this.replyToCommentId = null;
-          this.updateComments()
+          this.getCaptcha();
+          // With the event stream open the new reply arrives by itself
+          if (!this.$root.liveUpdates) {
+            this.updateComments();
+          }
         })
         .catch(error => {
           this.getCaptcha();
@@ -234,6 +303,9 @@ new Vue({
     test: 'ddddddddd',
     page: 1,
     total_pages: 1,
+    pageCursors: {},
+    liveUpdates: false,
+    since: null,
     post: null,
     comments: null,
     commentComponent: 'comment',
@@ -280,11 +352,25 @@ new Vue({
       const day = document.getElementById('app').getAttribute('data-day');
       const postURL = `/api/v1/comments/${year}/${month}/${day}/${postID}/`;
 
-      if (postURL) {
-        axios.get(postURL)
+      // Once a page is shown only the comments changed since then are fetched
+      if (this.since) {
+        getComments(`${postURL}?since=${encodeURIComponent(this.since)}`)
+          .then(response => {
+            response.data.comments.forEach(comment => this.applyComment(comment));
+            this.since = response.data.since;
+            if (response.data.has_more) {
+              this.updateComments();
+            }
+          })
+          .catch(error => {
+            console.error('Error loading data:', error);
+          });
+      } else if (postURL) {
+        getComments(`${postURL}?replies=${INLINE_REPLIES}`)
           .then(response => {
             this.post = response.data.post;
             this.comments = response.data.comments;
+            this.since = response.data.since;
           })
           .catch(error => {
             console.error('Error loading data:', error);
@@ -317,17 +403,26 @@ new Vue({
       const day = document.getElementById('app').getAttribute('data-day');
       let sort_by = this.comment_form.sort_by;
       let order = this.comment_form.order;
-      let postURL = `/api/v1/comments/${year}/${month}/${day}/${postID}/?page=${page}`;
+      let postURL = `/api/v1/comments/${year}/${month}/${day}/${postID}/?page=${page}&replies=${INLINE_REPLIES}`;
+      // Pages already reached through "Next" are fetched by cursor, which costs the same at any depth
+      const cursor = this.pageCursors[page];
+      if (cursor) {
+        postURL = `/api/v1/comments/${year}/${month}/${day}/${postID}/?cursor=${encodeURIComponent(cursor)}&replies=${INLINE_REPLIES}`;
+      }
       if (sort_by) {
         postURL += `&sort_by=${sort_by}&order=${order}`;
       }
       if (postURL) {
-        axios.get(postURL)
+        getComments(postURL)
           .then(response => {
             this.post = response.data.post;
             this.comments = response.data.comments;
-            this.page = response.data.page;
-            this.total_pages = response.data.total_pages;
+            this.since = response.data.since;
+            this.page = page;
+            if (response.data.total_pages) {
+              this.total_pages = response.data.total_pages;
+            }
+            this.pageCursors[page + 1] = response.data.next_cursor;
           })
           .catch(error => {
             console.error('Error loading data:', error);
@@ -348,14 +443,20 @@ new Vue({
 
       this.comment_form.sort_by = currentSortBy;
       this.comment_form.order = currentOrder;
+      // Cursors are bound to the ordering they were issued for
+      this.pageCursors = {};
 
-      const postURL = `/api/v1/comments/${year}/${month}/${day}/${postID}/?sort_by=${currentSortBy}&order=${currentOrder}`;
+      const postURL = `/api/v1/comments/${year}/${month}/${day}/${postID}/?sort_by=${currentSortBy}&order=${currentOrder}&replies=${INLINE_REPLIES}`;
 
       if (postURL) {
-          axios.get(postURL)
+          getComments(postURL)
               .then(response => {
                   this.post = response.data.post;
                   this.comments = response.data.comments;
+                  this.since = response.data.since;
+                  this.page = 1;
+                  this.total_pages = response.data.total_pages;
+                  this.pageCursors[2] = response.data.next_cursor;
               })
               .catch(error => {
                   console.error('Error loading data:', error);
@@ -364,6 +465,104 @@ new Vue({
       const button = event.target;
       button.textContent = `${this.sortButtonTexts[currentSortBy]} (${currentOrder === 'asc' ? '↑' : '↓'})`;
   },
+    listenForComments() {
+      const postID = document.getElementById('app').getAttribute('data-post-id');
+      const year = document.getElementById('app').getAttribute('data-year');
+      const month = document.getElementById('app').getAttribute('data-month');
+      const day = document.getElementById('app').getAttribute('data-day');
+      if (!window.EventSource) {
+        return;
+      }
+      // New comments are pushed as single deltas and grafted into the tree that is already shown
+      const events = new EventSource(`/api/v1/async/comments/${year}/${month}/${day}/${postID}/events/`);
+      events.onopen = () => {
+        // After a reconnect, pick up whatever was missed while the stream was down
+        if (!this.liveUpdates && this.since) {
+          this.updateComments();
+        }
+        this.liveUpdates = true;
+      };
+      events.onerror = () => {
+        this.liveUpdates = false;
+      };
+      events.addEventListener('comment', event => this.insertComment(JSON.parse(event.data)));
+      events.addEventListener('update', event => this.applyComment(JSON.parse(event.data)));
+    },
+    applyComment(comment) {
+      // Known comments are patched in place, new ones are grafted into the tree
+      const shown = this.findComment(this.comments, comment.id);
+      if (shown) {
+        Object.assign(shown, comment, {children: shown.children, reply_count: shown.reply_count});
+      } else {
+        this.insertComment(comment);
+      }
+    },
+    findComment(comments, id) {
+      for (const comment of comments || []) {
+        if (comment.id === id) {
+          return comment;
+        }
+        const found = this.findComment(comment.children, id);
+        if (found) {
+          return found;
+        }
+      }
+      return null;
+    },
+    compareComments(a, b) {
+      // Same order as the API: ids follow creation time and break ties
+      const sortBy = this.comment_form.sort_by;
+      const desc = !sortBy || this.comment_form.order === 'desc';
+      let result = 0;
+      if (sortBy === 'user_name' || sortBy === 'email') {
+        result = a[sortBy] < b[sortBy] ? -1 : a[sortBy] > b[sortBy] ? 1 : 0;
+      }
+      if (result === 0) {
+        result = a.id - b.id;
+      }
+      return desc ? -result : result;
+    },
+    insertComment(comment) {
+      if (!this.comments || this.findComment(this.comments, comment.id)) {
+        return;
+      }
+      comment.children = [];
+      let siblings = this.comments;
+      if (comment.parent_comment) {
+        const parent = this.findComment(this.comments, comment.parent_comment);
+        // Replies to threads on other pages are seen when that page is opened
+        if (!parent) {
+          return;
+        }
+        const hasHiddenReplies = parent.reply_count > parent.children.length;
+        parent.reply_count += 1;
+        siblings = parent.children;
+        // Behind replies that are not loaded yet it shows up with "Show more replies"
+        if (hasHiddenReplies && !siblings.some(sibling => this.compareComments(comment, sibling) < 0)) {
+          return;
+        }
+      } else if (this.page !== 1) {
+        return;
+      }
+      comment.replies_cursor = null;
+      const index = siblings.findIndex(sibling => this.compareComments(comment, sibling) < 0);
+      if (index === -1) {
+        // A root that sorts after the whole first page belongs to a later one
+        if (!comment.parent_comment && siblings.length >= 25) {
+          return;
+        }
+        siblings.push(comment);
+      } else {
+        siblings.splice(index, 0, comment);
+      }
+      if (!comment.parent_comment) {
+        // The later pages have shifted, so their cursors are no longer valid
+        this.pageCursors = {};
+        if (siblings.length > 25) {
+          siblings.pop();
+        }
+      }
+    },
     handleImageUpload(event) {
       this.commentForm.image = event.target.files[0];
     },
@@ -404,7 +603,10 @@ new Vue({
       axios.post(postURL, formData, config)
         .then(response => {
           this.showForm = false;
-          this.updateComments();
+          this.getCaptcha();
+          if (!this.liveUpdates) {
+            this.updateComments();
+          }
         })
         .catch(error => {
           this.getCaptcha();
@@ -419,7 +621,7 @@ new Vue({
 
   },
   created() {
-    this.updateComments();
     this.loadPage(1);
+    this.listenForComments();
   },
 });
\ No newline at end of file
@@ -1,9 +1,10 @@
 from django.contrib import admin
-from .models import Post, Comment
+from .models import Post, Comment, UserInfo
+from .search import comment_search_filter
 
 
 class PostAdmin(admin.ModelAdmin):
-    list_display = ('title', 'id', 'author', 'publish', 'status')
+    list_display = ('title', 'id', 'author', 'publish', 'status', 'comment_count', 'last_comment_at')
     list_filter = ('status', 'created', 'publish', 'author')
     search_fields = ('title', 'body')
     raw_id_fields = ('author',)
@@ -17,8 +18,24 @@ admin.site.register(Post, PostAdmin)
 class CommentAdmin(admin.ModelAdmin):
     list_display = ('user_name', 'email', 'text', 'created_at')
     list_filter = ('created_at', 'updated_at')
-    search_fields = ('name', 'email', 'body')
+    # Exact author matches here, text and user name words through the full-text index
+    search_fields = ('=user_name', '=email')
     ordering = ('-created_at',)
 
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            results |= queryset.filter(comment_search_filter(search_term))
+        return results, may_have_duplicates
+
 
 admin.site.register(Comment, CommentAdmin)
+
+
+class UserInfoAdmin(admin.ModelAdmin):
+    list_display = ('user_name', 'email', 'comment_count', 'last_seen')
+    search_fields = ('user_name', 'email')
+    ordering = ('-last_seen',)
+
+
+admin.site.register(UserInfo, UserInfoAdmin)
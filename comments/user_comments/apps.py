@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class UserCommentsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "user_comments"
+
+    def ready(self):
+        from . import instrumentation, signals  # noqa: F401
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Query parameters that change the comments page payload
+COMMENT_PAGE_PARAMS = ('sort_by', 'order', 'page', 'cursor', 'since', 'replies')
+
+# ...and the ones that only change how it is rendered
+COMMENT_RENDER_PARAMS = ('layout', 'format')
+
+POSTS_GENERATION_KEY = 'posts:generation'
+
+
+def post_generation_key(post_id):
+    return f'comments:post:{post_id}:generation'
+
+
+def get_generation(key):
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock, so a lost counter never comes back to an already used generation
+        generation = time.time_ns() // 1000
+        if not cache.add(key, generation, timeout=None):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        get_generation(key)
+
+
+def get_post_generation(post_id):
+    return get_generation(post_generation_key(post_id))
+
+
+def bump_post_generation(post_id):
+    # Every cached page of the post is keyed by the generation, so bumping it invalidates them all
+    bump_generation(post_generation_key(post_id))
+
+
+def get_posts_generation():
+    # Changes with any post, for the post listing
+    return get_generation(POSTS_GENERATION_KEY)
+
+
+def bump_posts_generation():
+    bump_generation(POSTS_GENERATION_KEY)
+
+
+def post_list_cache_key(generation, page_number):
+    return f'posts:{generation}:list:{page_number}'
+
+
+def comment_page_cache_key(post_id, generation, params):
+    values = [params.get(name) for name in COMMENT_PAGE_PARAMS]
+    digest = hashlib.md5(json.dumps(values).encode()).hexdigest()
+    return f'comments:post:{post_id}:{generation}:page:{digest}'
+
+
+def get_cached_comment_page(post_id, generation, params):
+    key = comment_page_cache_key(post_id, generation, params)
+    return key, cache.get(key)
+
+
+def set_cached_comment_page(key, payload):
+    cache.set(key, payload, settings.COMMENTS_CACHE_TIMEOUT)
+
+
+def comment_representation_digest(request):
+    # Everything that makes one response body differ from another under the same generation
+    values = [request.path, request.headers.get('Accept', '')]
+    values += [request.GET.get(name) for name in COMMENT_PAGE_PARAMS + COMMENT_RENDER_PARAMS]
+    return hashlib.md5(json.dumps(values).encode()).hexdigest()
+
+
+def comment_page_etag(post_id, generation, digest, encoding=None):
+    # Strong: the generation changes with every write that can change the body. A strong
+    # validator has to differ between content-codings, so compressed bodies carry the coding
+    if encoding:
+        return f'"{post_id}-{generation}-{digest}-{encoding}"'
+    return f'"{post_id}-{generation}-{digest}"'
+
+
+def comment_body_cache_key(post_id, generation, digest, encoding):
+    return f'comments:post:{post_id}:{generation}:body:{digest}:{encoding}'
+
+
+def get_cached_body(key):
+    return cache.get(key)
+
+
+def set_cached_body(key, body):
+    cache.set(key, body, settings.COMMENTS_CACHE_TIMEOUT)
@@ -0,0 +1,75 @@
+import secrets
+from datetime import timedelta
+
+from captcha.conf import settings as captcha_settings
+from captcha.models import CaptchaStore
+from captcha.views import captcha_image
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import CaptchaPoolEntry
+
+
+def get_min_expiration():
+    # An issued key must stay valid for the usual solving time
+    return timezone.now() + timedelta(minutes=captcha_settings.CAPTCHA_TIMEOUT)
+
+
+def pop_captcha():
+    # Claims one pre-generated key, or returns None when the pool is empty
+    with transaction.atomic():
+        entry = (CaptchaPoolEntry.objects.select_for_update(skip_locked=True)
+                 .filter(issued=False, expiration__gt=get_min_expiration())
+                 .order_by('id').values_list('id', 'hashkey').first())
+        if entry is None:
+            return None
+        CaptchaPoolEntry.objects.filter(id=entry[0]).update(issued=True)
+    return entry[1]
+
+
+def get_captcha_pool_image(key):
+    image = CaptchaPoolEntry.objects.filter(hashkey=key).values_list('image', flat=True).first()
+    # Postgres returns a memoryview for binary columns
+    return bytes(image) if image is not None else None
+
+
+def count_free_captchas():
+    return CaptchaPoolEntry.objects.filter(issued=False, expiration__gt=get_min_expiration()).count()
+
+
+def fill_captcha_pool(count, batch_size=200):
+    # Keys are inserted in bulk, then every image is rendered once and stored next to its key
+    expiration = timezone.now() + timedelta(seconds=settings.COMMENTS_CAPTCHA_POOL_LIFETIME)
+    challenge_funct = captcha_settings.get_challenge()
+    created = 0
+    while created < count:
+        stores = []
+        for _ in range(min(batch_size, count - created)):
+            challenge, response = challenge_funct()
+            stores.append(CaptchaStore(challenge=challenge, response=response.lower(),
+                                       hashkey=secrets.token_hex(20), expiration=expiration))
+        CaptchaStore.objects.bulk_create(stores)
+        CaptchaPoolEntry.objects.bulk_create([
+            CaptchaPoolEntry(hashkey=store.hashkey, image=captcha_image(None, store.hashkey).content,
+                             expiration=expiration)
+            for store in stores
+        ])
+        created += len(stores)
+    return created
+
+
+def delete_in_batches(queryset, batch_size):
+    # Short DELETEs by primary key keep locks and WAL bursts small on large tables
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += queryset.model.objects.filter(pk__in=ids).delete()[0]
+
+
+def purge_expired_captchas(batch_size=1000):
+    now = timezone.now()
+    return (delete_in_batches(CaptchaPoolEntry.objects.filter(expiration__lte=now), batch_size) +
+            delete_in_batches(CaptchaStore.objects.filter(expiration__lte=now), batch_size))
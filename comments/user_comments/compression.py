@@ -0,0 +1,46 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def parse_accept_encoding(header):
+    # Coding -> q-value; a malformed q counts as refused
+    qualities = {}
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def get_accepted_encoding(request):
+    # The client's most preferred of the codings available here; brotli (when the optional package
+    # is installed) wins a tie with gzip. Codings sent with q=0 are refused, not accepted
+    qualities = parse_accept_encoding(request.headers.get('Accept-Encoding', ''))
+    wildcard = qualities.get('*', 0.0)
+    available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best, best_quality = None, 0.0
+    for coding in available:
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    # A fixed mtime keeps the bytes identical for identical bodies
+    return gzip.compress(body, mtime=0)
@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Comment, Post
+
+
+def comment_aggregate(comments, aggregate):
+    # Correlated per-post aggregate, for annotating a Post queryset
+    return Subquery(comments.filter(post=OuterRef('pk')).order_by().values('post').annotate(value=aggregate)
+                    .values('value'))
+
+
+def reconcile_posts(post_ids):
+    # Recounts the posts from their comments and fixes the ones that drifted, returning their ids;
+    # the posts stay locked meanwhile, so no create or delete slips in between count and write
+    with transaction.atomic():
+        posts = (Post.objects.select_for_update().filter(id__in=post_ids).only(*Post.COUNTER_FIELDS).annotate(
+            actual_comments=Coalesce(comment_aggregate(Comment.objects.all(), Count('id')), Value(0),
+                                     output_field=IntegerField()),
+            actual_roots=Coalesce(comment_aggregate(Comment.objects.filter(parent_comment__isnull=True), Count('id')),
+                                  Value(0), output_field=IntegerField()),
+            actual_last=comment_aggregate(Comment.objects.all(), Max('created_at')),
+        ))
+        drifted = []
+        for post in posts:
+            actual = (post.actual_comments, post.actual_roots, post.actual_last)
+            if (post.comment_count, post.root_count, post.last_comment_at) != actual:
+                post.comment_count, post.root_count, post.last_comment_at = actual
+                drifted.append(post)
+        Post.objects.bulk_update(drifted, Post.COUNTER_FIELDS)
+    return [post.id for post in drifted]
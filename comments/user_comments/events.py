@@ -0,0 +1,153 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .models import Comment
+from .serializers import COMMENT_VALUES, serialize_comment_rows
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keep-alive comments on an idle stream, so proxies don't drop it
+EVENTS_HEARTBEAT = 15
+
+# Seconds before the Redis subscription of a process is opened again after losing it
+EVENTS_RECONNECT_DELAY = 1
+
+# Seconds a publish may wait on Redis; it runs in the request that saved the comment
+EVENTS_REDIS_TIMEOUT = 0.5
+
+# Seconds between checks that the idle subscription connection is still alive
+EVENTS_HEALTH_CHECK_INTERVAL = 30
+
+
+def post_events_channel(post_id):
+    return f'comments:post:{post_id}:events'
+
+
+class MemoryBroker:
+    # Fan-out between the streams of one process; enough for runserver and tests
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+    def deliver(self, channel, message):
+        # Called from request threads, while the streams wait on the event loop
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+            except RuntimeError:
+                # The loop of a finished stream is already closed
+                pass
+
+    async def listen(self, channel):
+        # Yields published messages, and None whenever the channel stays quiet for a heartbeat
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(subscriber)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscriber[1].get(), EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self.lock:
+                subscribers = self.subscribers[channel]
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[channel]
+
+
+class RedisBroker(MemoryBroker):
+    # Redis pub/sub delivers every event to all worker processes. A process holds a single
+    # subscription to all post channels, read by one thread that fans the events out to its
+    # own streams, so open streams don't cost a Redis connection each
+    def __init__(self, url):
+        super().__init__()
+        self.client = redis.Redis.from_url(url, socket_timeout=EVENTS_REDIS_TIMEOUT,
+                                           socket_connect_timeout=EVENTS_REDIS_TIMEOUT)
+        # The subscription waits for events indefinitely, so it gets a client without a read timeout
+        self.subscriber = redis.Redis.from_url(url, socket_connect_timeout=EVENTS_REDIS_TIMEOUT,
+                                               health_check_interval=EVENTS_HEALTH_CHECK_INTERVAL)
+        self.reader = None
+
+    def publish(self, channel, message):
+        try:
+            self.client.publish(channel, message)
+        except redis.RedisError:
+            # Watchers miss a live update, the comment itself is already saved
+            logger.warning('Publishing to %s failed', channel, exc_info=True)
+
+    def listen(self, channel):
+        # Processes that never stream don't subscribe at all
+        with self.lock:
+            if self.reader is None:
+                self.reader = threading.Thread(target=self.read_events, name='comment-events', daemon=True)
+                self.reader.start()
+        return super().listen(channel)
+
+    def read_events(self):
+        while True:
+            pubsub = self.subscriber.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(post_events_channel('*'))
+                for message in pubsub.listen():
+                    # Events of posts nobody here is watching find no subscribers and are dropped
+                    self.deliver(message['channel'].decode(), message['data'].decode())
+            except redis.RedisError:
+                # Streams stay open but miss the events published until the subscription is back
+                logger.warning('Comment events subscription lost, reconnecting', exc_info=True)
+                time.sleep(EVENTS_RECONNECT_DELAY)
+            finally:
+                pubsub.close()
+
+
+broker = None
+
+
+def get_broker():
+    global broker
+    if broker is None:
+        broker = RedisBroker(settings.REDIS_URL) if settings.REDIS_URL else MemoryBroker()
+    return broker
+
+
+def get_comment_row(comment):
+    # The row .values(*COMMENT_VALUES) would return for a saved instance
+    row = {name: getattr(comment, name) for name in COMMENT_VALUES}
+    row['image'] = comment.image.name
+    row['text_file'] = comment.text_file.name
+    return row
+
+
+def publish_comment_event(event, row):
+    # A ready-made SSE frame, so the streams only have to pass it on
+    data = json.dumps(serialize_comment_rows([row])[0], separators=(',', ':'))
+    get_broker().publish(post_events_channel(row['post_id']), f'event: {event}\ndata: {data}\n\n')
+
+
+def publish_new_comment(comment):
+    publish_comment_event('comment', get_comment_row(comment))
+
+
+def publish_comment_update(comment_id):
+    row = Comment.objects.filter(pk=comment_id).values(*COMMENT_VALUES).first()
+    if row is not None:
+        publish_comment_event('update', row)
+
+
+async def stream_post_events(post_id):
+    yield 'retry: 5000\n\n'
+    async for message in get_broker().listen(post_events_channel(post_id)):
+        yield message if message is not None else ': ping\n\n'
@@ -0,0 +1,88 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .cache import bump_post_generation
+from .events import publish_comment_update
+from .models import Comment
+
+
+logger = logging.getLogger(__name__)
+
+# Images larger than this are scaled down proportionally to fit
+THUMBNAIL_SIZE = (320, 240)
+
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='comment-images')
+
+
+def make_thumbnail(comment):
+    # Returns False when the image already fits and is kept as uploaded
+    with comment.image.open('rb') as image_file:
+        img = Image.open(image_file)
+        image_format = img.format
+        if img.width <= THUMBNAIL_SIZE[0] and img.height <= THUMBNAIL_SIZE[1]:
+            return False
+        # Only the first frame of an animated GIF is kept
+        img.thumbnail(THUMBNAIL_SIZE)
+        output_buffer = BytesIO()
+        img.save(output_buffer, format=image_format)
+
+    original_name = comment.image.name
+    comment.image.save(os.path.basename(original_name), ContentFile(output_buffer.getvalue()), save=False)
+    comment.image.storage.delete(original_name)
+    return True
+
+
+def process_comment_image(comment_id):
+    # The row lock makes the job safe to race between the in-process runner and worker processes
+    with transaction.atomic():
+        comment = (Comment.objects.select_for_update(skip_locked=True)
+                   .filter(pk=comment_id, image_status='processing').first())
+        if comment is None:
+            return False
+        try:
+            make_thumbnail(comment)
+            image_status = 'ready'
+        except Exception:
+            logger.exception('Thumbnailing the image of comment %s failed', comment_id)
+            image_status = 'failed'
+        # updated_at moves too, so ?since= clients pick up the new status
+        Comment.objects.filter(pk=comment.pk, image_status='processing').update(
+            image=comment.image.name, image_status=image_status, updated_at=timezone.now())
+
+    # update() skips the model signals, so cached pages are invalidated here
+    bump_post_generation(comment.post_id)
+    publish_comment_update(comment.pk)
+    return True
+
+
+def process_pending_images(limit):
+    # One batch of the queue: comments still waiting for their thumbnail, oldest first
+    comment_ids = list(Comment.objects.filter(image_status='processing').order_by('id')
+                       .values_list('id', flat=True)[:limit])
+    return sum(process_comment_image(comment_id) for comment_id in comment_ids)
+
+
+def run_in_thread(comment_id):
+    try:
+        process_comment_image(comment_id)
+    finally:
+        connection.close()
+
+
+def enqueue_image_processing(comment):
+    # Thumbnails are made after the comment is committed, outside of the request
+    mode = settings.COMMENTS_IMAGE_PROCESSING
+    comment_id = comment.id
+    if mode == 'inline':
+        transaction.on_commit(lambda: process_comment_image(comment_id))
+    elif mode == 'thread':
+        transaction.on_commit(lambda: executor.submit(run_in_thread, comment_id))
+    # In 'worker' mode the pending row is picked up by manage.py process_images
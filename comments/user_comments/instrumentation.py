@@ -0,0 +1,150 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+logger = logging.getLogger('user_comments.requests')
+
+# Methods get their own label, anything else is counted as 'OTHER'
+METRIC_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+# Histogram buckets of the request duration, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimings:
+    # Collected for one request; sync_to_async copies the context, so worker threads add to the same object
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.spans = {}
+
+    def add_span(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+
+current_timings = ContextVar('current_timings', default=None)
+
+
+@contextmanager
+def span(name):
+    # Named phase of the current request; a no-op outside of one (commands, background threads)
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_span(name, time.perf_counter() - started)
+
+
+def record_query(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db_time += time.perf_counter() - started
+        timings.db_queries += 1
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Every connection, in whatever thread it is opened, reports to the request it runs a query for
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def server_timing_header(timings, total):
+    entries = [f'total;dur={total * 1000:.1f}',
+               f'db;dur={timings.db_time * 1000:.1f};desc="queries={timings.db_queries}"']
+    entries += [f'{name};dur={duration * 1000:.1f}' for name, duration in timings.spans.items()]
+    return ', '.join(entries)
+
+
+def get_route(request):
+    # The URL pattern name keeps the label set small, whatever the ids in the path
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+class Metrics:
+    # Prometheus text format without a client library. Counts are per process,
+    # so with several workers every one of them is scraped on its own
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.db_queries = {}
+        self.db_seconds = {}
+        self.span_seconds = {}
+
+    def observe(self, route, method, timings, total):
+        labels = (route, method)
+        with self.lock:
+            histogram = self.durations.setdefault(labels, [[0] * len(DURATION_BUCKETS), 0, 0.0])
+            index = bisect.bisect_left(DURATION_BUCKETS, total)
+            if index < len(DURATION_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += total
+            self.db_queries[labels] = self.db_queries.get(labels, 0) + timings.db_queries
+            self.db_seconds[labels] = self.db_seconds.get(labels, 0.0) + timings.db_time
+            for name, duration in timings.spans.items():
+                key = (route, name)
+                self.span_seconds[key] = self.span_seconds.get(key, 0.0) + duration
+
+    def render(self):
+        lines = ['# TYPE comments_request_duration_seconds histogram']
+        with self.lock:
+            for (route, method), (buckets, count, total) in sorted(self.durations.items()):
+                labels = f'route="{route}",method="{method}"'
+                cumulative = 0
+                for bound, observed in zip(DURATION_BUCKETS, buckets):
+                    cumulative += observed
+                    lines.append(f'comments_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'comments_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'comments_request_duration_seconds_sum{{{labels}}} {total}')
+                lines.append(f'comments_request_duration_seconds_count{{{labels}}} {count}')
+            lines.append('# TYPE comments_request_db_queries_total counter')
+            for (route, method), value in sorted(self.db_queries.items()):
+                lines.append(f'comments_request_db_queries_total{{route="{route}",method="{method}"}} {value}')
+            lines.append('# TYPE comments_request_db_seconds_total counter')
+            for (route, method), value in sorted(self.db_seconds.items()):
+                lines.append(f'comments_request_db_seconds_total{{route="{route}",method="{method}"}} {value}')
+            lines.append('# TYPE comments_request_span_seconds_total counter')
+            for (route, name), value in sorted(self.span_seconds.items()):
+                lines.append(f'comments_request_span_seconds_total{{route="{route}",span="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def finish_request(request, response, timings):
+    total = time.perf_counter() - timings.started
+    route = get_route(request)
+    method = request.method if request.method in METRIC_METHODS else 'OTHER'
+    if settings.COMMENTS_SERVER_TIMING:
+        response['Server-Timing'] = server_timing_header(timings, total)
+    if settings.COMMENTS_METRICS:
+        metrics.observe(route, method, timings, total)
+
+    # One logfmt line per request
+    fields = [f'method={method}', f'route={route}', f'status={response.status_code}',
+              f'duration_ms={total * 1000:.1f}', f'db_queries={timings.db_queries}',
+              f'db_ms={timings.db_time * 1000:.1f}']
+    fields += [f'span_{name}_ms={duration * 1000:.1f}' for name, duration in timings.spans.items()]
+    logger.info(' '.join(fields))
+    return response
@@ -0,0 +1,160 @@
+import io
+import json
+import resource
+import statistics
+import time
+
+from captcha.models import CaptchaStore
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from user_comments.cache import bump_post_generation, bump_posts_generation
+from user_comments.models import Comment, Post
+from user_comments.tree import COMMENTS_PAGE_SIZE, SORT_FIELDS
+
+
+class Rollback(Exception):
+    pass
+
+
+def png_upload(name):
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 600), 'white').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), 'image/png')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = ('Time the comment endpoints through the full request stack and report p50/p95 latency, '
+            'queries per request and peak RSS; writes are rolled back')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--post', type=int, help='Post to read and write (default: the one with most comments)')
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per scenario')
+        parser.add_argument('--warm', action='store_true',
+                            help='Let the page caches answer; by default every read misses them')
+        parser.add_argument('--only', help='Run the scenarios whose name contains this text')
+        parser.add_argument('--json', help='Also write the results to this file, for comparing runs')
+
+    def handle(self, *args, **options):
+        post = self.get_post(options['post'])
+        self.client = Client()
+        self.results = []
+        self.stored_files = []
+        # The benchmark client would hit the rate limits and the allowed hosts of the real configuration
+        limits = {scope: (10 ** 9, 10 ** 9) for scope in settings.COMMENTS_RATE_LIMITS}
+        with override_settings(COMMENTS_RATE_LIMITS=limits, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            try:
+                with transaction.atomic():
+                    self.run(post, options)
+                    raise Rollback
+            except Rollback:
+                pass
+            finally:
+                for storage, name in self.stored_files:
+                    storage.delete(name)
+
+        self.stdout.write(f'{"scenario":<40} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8} {"queries":>8} '
+                          f'{"RSS MB":>7}')
+        for result in self.results:
+            self.stdout.write(f'{result["name"]:<40} {result["p50"]:>8.2f} {result["p95"]:>8.2f} '
+                              f'{result["max"]:>8.2f} {result["queries"]:>8} {result["rss"]:>7.0f}')
+        if options['json']:
+            with open(options['json'], 'w') as output:
+                json.dump({'vendor': connection.vendor, 'post': post.id, 'comments': post.comment_count,
+                           'warm': options['warm'], 'results': self.results}, output, indent=2)
+
+    def get_post(self, post_id):
+        posts = Post.objects.filter(status='published')
+        post = posts.filter(id=post_id).first() if post_id else posts.order_by('-comment_count').first()
+        if post is None:
+            raise CommandError('No published post to benchmark, run seed_comments first')
+        return post
+
+    def run(self, post, options):
+        args = [post.publish.year, post.publish.month, post.publish.day, post.id]
+        list_url = reverse('user_comments:comment-list', args=args)
+        create_url = reverse('user_comments:create-comment', args=args)
+        pages = max(1, -(-post.root_count // COMMENTS_PAGE_SIZE))
+        cold = not options['warm']
+
+        def read(url, params=None):
+            if cold:
+                bump_post_generation(post.id)
+            return lambda: self.client.get(url, params)
+
+        scenarios = []
+        for sort_by in [None, *SORT_FIELDS]:
+            for order in ('asc', 'desc'):
+                for page in sorted({1, pages}):
+                    params = {'order': order, 'page': page}
+                    if sort_by:
+                        params['sort_by'] = sort_by
+                    scenarios.append((f'list {sort_by or "default"} {order} page {page}',
+                                      lambda params=params: read(list_url, params)))
+        scenarios.append(('list lazy replies page 1', lambda: read(list_url, {'replies': 3})))
+
+        def post_list():
+            if cold:
+                bump_posts_generation()
+            return lambda: self.client.get(reverse('user_comments:post_list'))
+        scenarios.append(('post listing', post_list))
+        scenarios.append(('get_captcha', lambda: lambda: self.client.get(reverse('user_comments:get_captcha'))))
+
+        counter = iter(range(10 ** 9))
+
+        def create(**files):
+            # The CAPTCHA is prepared outside the timing, like the page load that shows it would
+            key = CaptchaStore.generate_key()
+            data = {'user_name': 'bench', 'email': 'bench@example.com', 'text': f'Benchmark comment {next(counter)}',
+                    'captcha_key': key, 'captcha_value': CaptchaStore.objects.get(hashkey=key).response,
+                    **{name: make() for name, make in files.items()}}
+            return lambda: self.client.post(create_url, data)
+        scenarios.append(('create', lambda: create()))
+        scenarios.append(('create with image', lambda: create(image=lambda: png_upload('bench.png'))))
+        scenarios.append(('create with text file', lambda: create(
+            file=lambda: SimpleUploadedFile('bench.txt', b'benchmark ' * 100, 'text/plain'))))
+
+        for name, prepare in scenarios:
+            if options['only'] and options['only'] not in name:
+                continue
+            self.measure(name, prepare, options['requests'])
+
+    def measure(self, name, prepare, count):
+        # prepare() does the untimed setup of one request and returns the request itself
+        timings = []
+        queries = []
+        for _ in range(count):
+            request = prepare()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = request()
+                timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                raise CommandError(f'{name}: HTTP {response.status_code} {response.content[:200]!r}')
+            queries.append(len(captured))
+            self.remember_files(response)
+
+        p50 = statistics.median(timings)
+        p95 = statistics.quantiles(timings, n=20, method='inclusive')[-1] if len(timings) > 1 else timings[0]
+        self.results.append({'name': name, 'requests': count, 'p50': p50, 'p95': p95, 'max': max(timings),
+                             'queries': int(statistics.median(queries)), 'rss': peak_rss_mb()})
+
+    def remember_files(self, response):
+        # Uploads are written to storage before the transaction is rolled back; they are removed at the end
+        if response.get('Content-Type') != 'application/json' or 'comment_id' not in response.content.decode():
+            return
+        comment = Comment.objects.get(id=response.json()['comment_id'])
+        for field in (comment.image, comment.text_file):
+            if field:
+                self.stored_files.append((field.storage, field.name))
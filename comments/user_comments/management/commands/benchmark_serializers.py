@@ -0,0 +1,78 @@
+import statistics
+import time
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from user_comments.models import Post, Comment
+from user_comments.serializers import COMMENT_DATE_FORMAT, COMMENT_VALUES, CommentSerializer, \
+    serialize_comment_rows
+
+
+class Rollback(Exception):
+    pass
+
+
+def serialize_with_model_serializer(post):
+    # The previous read path: one ModelSerializer per comment, then the date parsed back and reformatted
+    comments = []
+    for comment in Comment.objects.filter(post=post).order_by('id'):
+        data = CommentSerializer(comment).data
+        created_at = datetime.fromisoformat(data['created_at'].replace('Z', '+00:00'))
+        data['created_at'] = created_at.strftime(COMMENT_DATE_FORMAT)
+        comments.append(data)
+    return comments
+
+
+def serialize_with_values(post):
+    return serialize_comment_rows(Comment.objects.filter(post=post).order_by('id').values(*COMMENT_VALUES))
+
+
+class Command(BaseCommand):
+    help = 'Compare the ModelSerializer and .values() comment serialization paths on generated comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--comments', type=int, default=10000, help='Number of comments to generate')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per path')
+
+    def handle(self, *args, **options):
+        # Everything is generated inside a transaction that is rolled back at the end
+        try:
+            with transaction.atomic():
+                self.run(options['comments'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, count, repeat):
+        author = User.objects.create(username=f'benchmark-{time.time_ns()}')
+        post = Post.objects.create(title='Benchmark', author=author, body='', status='published')
+        roots = Comment.objects.bulk_create(
+            Comment(user_name=f'user{i}', email=f'user{i}@example.com', post=post, text=f'Comment {i}')
+            for i in range(count // 2)
+        )
+        Comment.objects.bulk_create(
+            Comment(user_name=f'user{i}', email=f'user{i}@example.com', post=post, text=f'Reply {i}',
+                    parent_comment=roots[i % len(roots)], root=roots[i % len(roots)], depth=1)
+            for i in range(count - len(roots))
+        )
+
+        if serialize_with_model_serializer(post) != serialize_with_values(post):
+            raise CommandError('The two serialization paths produce different output')
+
+        results = {}
+        for name, serialize in (('ModelSerializer', serialize_with_model_serializer),
+                                ('values() rows', serialize_with_values)):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                serialize(post)
+                timings.append(time.perf_counter() - started)
+            results[name] = statistics.median(timings)
+            self.stdout.write(f'{name:>16}: median {results[name] * 1000:.1f} ms, '
+                              f'best {min(timings) * 1000:.1f} ms over {repeat} runs of {count} comments')
+
+        speedup = results['ModelSerializer'] / results['values() rows']
+        self.stdout.write(self.style.SUCCESS(f'values() rows are {speedup:.1f}x faster'))
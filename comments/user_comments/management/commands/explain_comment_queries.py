@@ -0,0 +1,81 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from user_comments.models import Post
+from user_comments.pagination import keyset_filter
+from user_comments.tree import SORT_FIELDS, COMMENTS_PAGE_SIZE, get_comment_ordering, get_root_comments, \
+    get_thread_replies
+
+# A table read without any index, per database vendor
+SEQUENTIAL_SCAN_PATTERNS = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (\w+)(?! USING)(?: AS \w+)?$', re.MULTILINE),
+}
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the queries behind the comments API and fail if any of them needs a sequential scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--post', type=int, help='Post to build the queries for (default: latest published)')
+
+    def handle(self, *args, **options):
+        pattern = SEQUENTIAL_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f'Unsupported database vendor: {connection.vendor}')
+
+        post = self.get_post(options['post'])
+        failures = []
+        for name, queryset in self.get_queries(post):
+            plan = self.explain(queryset)
+            scans = pattern.findall(plan)
+            if scans:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f'{name}: sequential scan on {", ".join(scans)}'))
+                self.stdout.write(plan)
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{name}: OK'))
+            if options['verbosity'] > 1:
+                self.stdout.write(plan)
+
+        if failures:
+            raise CommandError(f'{len(failures)} queries fall back to a sequential scan')
+
+    def get_post(self, post_id):
+        if post_id is not None:
+            return Post.objects.get(id=post_id)
+        post = Post.objects.filter(status='published').first()
+        # An empty database still has plans worth checking
+        return post or Post(id=0, publish=timezone.now())
+
+    def get_queries(self, post):
+        publish = post.publish
+        yield 'post detail', Post.objects.filter(id=post.id, status='published', publish__year=publish.year,
+                                                 publish__month=publish.month, publish__day=publish.day)
+        yield 'post listing', Post.objects.filter(status='published').order_by('-publish')
+
+        sample = {'id': 0, 'user_name': '', 'email': '', 'created_at': timezone.now()}
+        for sort_by in [None] + list(SORT_FIELDS):
+            for order in ('asc', 'desc'):
+                if sort_by is None and order == 'desc':
+                    continue
+                ordering = get_comment_ordering(sort_by, order)
+                label = f'{sort_by or "default"} {order}'
+                roots = get_root_comments(post).order_by(*ordering)
+                yield f'root page ({label})', roots[:COMMENTS_PAGE_SIZE]
+
+                field = ordering[0].lstrip('-')
+                keyset = keyset_filter(ordering, sample[field], sample['id'])
+                yield f'root cursor page ({label})', roots.filter(keyset)[:COMMENTS_PAGE_SIZE + 1]
+                yield f'thread replies ({label})', get_thread_replies([0]).order_by(*ordering)
+
+    def explain(self, queryset):
+        # With sequential scans priced out, the planner only picks one when no index can serve the query
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            return queryset.explain()
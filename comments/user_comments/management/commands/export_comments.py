@@ -0,0 +1,26 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from user_comments.transfer import TRANSFER_FORMATS, export_comments, get_record_writer, guess_format
+
+
+class Command(BaseCommand):
+    help = 'Stream posts, the author directory and comment threads to an NDJSON or msgpack file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-', help='File to write, stdout by default')
+        parser.add_argument('--format', choices=TRANSFER_FORMATS,
+                            help='Record format, by default guessed from the file name')
+        parser.add_argument('--post', type=int, action='append', dest='post_ids', help='Only this post (repeatable)')
+
+    def handle(self, *args, **options):
+        path = options['output']
+        fmt = options['format'] or guess_format(path)
+        stream = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            posts, comments = export_comments(get_record_writer(stream, fmt), options['post_ids'])
+        finally:
+            if stream is not sys.stdout.buffer:
+                stream.close()
+        self.stderr.write(f'Exported {posts} posts and {comments} comments')
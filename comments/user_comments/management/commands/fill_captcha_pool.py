@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from user_comments.captcha_pool import count_free_captchas, fill_captcha_pool, purge_expired_captchas
+
+
+class Command(BaseCommand):
+    help = 'Top up the pool of pre-rendered CAPTCHAs and purge expired ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=settings.COMMENTS_CAPTCHA_POOL_SIZE,
+                            help='Number of free CAPTCHAs to keep in the pool')
+        parser.add_argument('--loop', action='store_true', help='Keep refilling until stopped')
+        parser.add_argument('--interval', type=float, default=10.0, help='Seconds between refills in --loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            purged = purge_expired_captchas()
+            created = fill_captcha_pool(max(0, options['size'] - count_free_captchas()))
+            if purged or created:
+                self.stdout.write(f'Added {created} CAPTCHAs, purged {purged} expired rows')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,108 @@
+import multiprocessing
+import sys
+from contextlib import nullcontext
+from itertools import chain
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from user_comments.cache import bump_post_generation, bump_posts_generation
+from user_comments.counters import reconcile_posts
+from user_comments.models import Comment
+from user_comments.transfer import (TRANSFER_FORMATS, TransferError, decode_datetimes, guess_format,
+                                    import_comment_file, import_comment_records, import_posts, import_users,
+                                    read_records, recount_authors, reset_sequences)
+
+
+class Command(BaseCommand):
+    help = 'Load a file written by export_comments, in bulk INSERTs of whole batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='File to read, - for stdin')
+        parser.add_argument('--format', choices=TRANSFER_FORMATS,
+                            help='Record format, by default guessed from the file name')
+        parser.add_argument('--keep-ids', action='store_true',
+                            help='Insert posts and comments under their exported ids (restoring into an empty '
+                                 'database); new ids are allocated otherwise')
+        parser.add_argument('--author', help='Username for posts whose author does not exist here')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes importing comments in parallel, each one a share of the posts; '
+                                 'unlike a single process, a failed parallel import keeps what it wrote')
+
+    def handle(self, *args, **options):
+        path = options['input']
+        fmt = options['format'] or guess_format(path)
+        keep_ids = options['keep_ids']
+        batch_size = options['batch_size']
+        workers = options['workers']
+        if workers > 1 and (path == '-' or connection.vendor != 'postgresql'):
+            raise CommandError('Parallel import needs a file and PostgreSQL')
+
+        default_author = None
+        if options['author']:
+            default_author = User.objects.filter(username=options['author']).values_list('id', flat=True).first()
+            if default_author is None:
+                raise CommandError(f'No user "{options["author"]}"')
+
+        # A single process imports in one transaction, so a failure leaves nothing behind. Parallel
+        # workers need the posts and directory entries committed first and can't share one
+        atomic = transaction.atomic() if workers == 1 else nullcontext()
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        try:
+            with atomic:
+                post_map, count = self.import_records(stream, path, fmt, keep_ids, default_author, batch_size,
+                                                      workers)
+                if keep_ids:
+                    reset_sequences(Comment)
+                post_ids = list(post_map.values())
+                for start in range(0, len(post_ids), batch_size):
+                    reconcile_posts(post_ids[start:start + batch_size])
+                recount_authors()
+        except (TransferError, KeyError) as e:
+            raise CommandError(f'Import failed: {e!r}')
+        finally:
+            stream.close()
+
+        for post_id in post_ids:
+            bump_post_generation(post_id)
+        bump_posts_generation()
+        self.stdout.write(f'Imported {len(post_ids)} posts and {count} comments')
+
+    def import_records(self, stream, path, fmt, keep_ids, default_author, batch_size, workers):
+        # Posts and directory entries come first, the comments follow
+        records = read_records(stream, fmt)
+        posts = []
+        post_map = None
+        users = []
+        first_comment = None
+        for record in records:
+            if record['type'] == 'post':
+                posts.append(decode_datetimes(record))
+                continue
+            if post_map is None:
+                post_map = import_posts(posts, keep_ids, default_author)
+            if record['type'] == 'user':
+                users.append({name: record[name] for name in ('user_name', 'email')})
+                if len(users) >= batch_size:
+                    import_users(users, batch_size)
+                    users = []
+            else:
+                first_comment = record
+                break
+        if post_map is None:
+            post_map = import_posts(posts, keep_ids, default_author)
+        import_users(users, batch_size)
+
+        if workers > 1:
+            stream.close()
+            # Worker processes open their own connections; an inherited one must not be shared
+            connections.close_all()
+            tasks = [(path, fmt, post_map, keep_ids, batch_size, worker, workers) for worker in range(workers)]
+            with multiprocessing.Pool(workers, initializer=django.setup) as pool:
+                return post_map, sum(pool.starmap(import_comment_file, tasks))
+        if first_comment is not None:
+            return post_map, import_comment_records(chain([first_comment], records), post_map, keep_ids, batch_size)
+        return post_map, 0
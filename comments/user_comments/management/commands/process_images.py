@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from user_comments.images import process_pending_images
+
+
+class Command(BaseCommand):
+    help = 'Make thumbnails for comment images waiting in the processing queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process one batch and exit')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending_images(options['batch_size'])
+            if processed:
+                self.stdout.write(f'Processed {processed} images')
+            if options['once']:
+                break
+            if not processed:
+                time.sleep(options['interval'])
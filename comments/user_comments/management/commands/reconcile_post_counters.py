@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from user_comments.cache import bump_post_generation, bump_posts_generation
+from user_comments.counters import reconcile_posts
+from user_comments.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Recount the comment counters of posts from their comments and fix the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('post_ids', nargs='*', type=int, help='Posts to check, all of them by default')
+        parser.add_argument('--batch-size', type=int, default=500, help='Posts locked and recounted at a time')
+
+    def handle(self, *args, **options):
+        post_ids = options['post_ids'] or list(Post.objects.order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        fixed = []
+        for start in range(0, len(post_ids), batch_size):
+            fixed += reconcile_posts(post_ids[start:start + batch_size])
+
+        # Cached pages and the listing show the counters
+        for post_id in fixed:
+            bump_post_generation(post_id)
+        if fixed:
+            bump_posts_generation()
+        self.stdout.write(f'Checked {len(post_ids)} posts, fixed the counters of {len(fixed)}')
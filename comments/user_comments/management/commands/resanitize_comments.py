@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from user_comments.cache import bump_post_generation
+from user_comments.models import Comment
+from user_comments.sanitizer import sanitize_text, text_digest
+
+
+def resanitize_range(bounds):
+    # One id range per call, so workers never load the same rows; changes go back in bulk UPDATEs
+    start, end = bounds
+    now = timezone.now()
+    changed_text = []
+    changed_hash = []
+    invalid = []
+    for comment in Comment.objects.filter(id__gte=start, id__lt=end).only('id', 'post_id', 'text', 'text_hash'):
+        text, well_formed = sanitize_text(comment.text)
+        if not well_formed:
+            invalid.append(comment.id)
+        text_hash = text_digest(text)
+        if text != comment.text:
+            # A changed text is a change of the comment, also for ?since= readers
+            comment.text, comment.text_hash, comment.updated_at = text, text_hash, now
+            changed_text.append(comment)
+        elif text_hash != comment.text_hash:
+            comment.text_hash = text_hash
+            changed_hash.append(comment)
+    Comment.objects.bulk_update(changed_text, ['text', 'text_hash', 'updated_at'])
+    Comment.objects.bulk_update(changed_hash, ['text_hash'])
+    return len(changed_text), len(changed_hash), invalid, {comment.post_id for comment in changed_text}
+
+
+class Command(BaseCommand):
+    help = 'Run all stored comment texts through the sanitizer again, in parallel worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=1000, help='Comment ids per unit of work')
+
+    def handle(self, *args, **options):
+        bounds = Comment.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            return
+        batch_size = options['batch_size']
+        ranges = [(start, start + batch_size) for start in range(bounds['first'], bounds['last'] + 1, batch_size)]
+
+        texts = hashes = 0
+        invalid = []
+        post_ids = set()
+        if options['workers'] > 1:
+            # Worker processes open their own connections; an inherited one must not be shared
+            connections.close_all()
+            with multiprocessing.Pool(options['workers'], initializer=django.setup) as pool:
+                results = list(pool.imap_unordered(resanitize_range, ranges))
+        else:
+            results = map(resanitize_range, ranges)
+        for changed_text, changed_hash, range_invalid, range_post_ids in results:
+            texts += changed_text
+            hashes += changed_hash
+            invalid += range_invalid
+            post_ids |= range_post_ids
+
+        for post_id in post_ids:
+            bump_post_generation(post_id)
+        if invalid:
+            self.stderr.write(f'Not valid XHTML after cleaning: {", ".join(map(str, sorted(invalid)))}')
+        self.stdout.write(f'Sanitized {texts} comment texts, stored {hashes} missing hashes')
@@ -0,0 +1,78 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user_comments.cache import bump_post_generation, bump_posts_generation
+from user_comments.counters import reconcile_posts
+from user_comments.models import Post
+from user_comments.transfer import CommentImporter, recount_authors
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'minim', 'veniam')
+
+
+class Command(BaseCommand):
+    help = 'Generate published posts with comment trees of a given shape, for benchmarks and load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=1)
+        parser.add_argument('--roots', type=int, default=100, help='Root comments per post')
+        parser.add_argument('--depth', type=int, default=2, help='Reply levels below every root comment')
+        parser.add_argument('--fanout', type=int, default=3, help='Replies per comment on every level')
+        parser.add_argument('--users', type=int, default=200, help='Distinct comment authors')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for reproducible data')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        author, _ = User.objects.get_or_create(username='seed')
+        now = timezone.now()
+        posts = [Post.objects.create(title=f'Seeded post {i + 1}', author=author, body=self.words(rng, 200),
+                                     status='published', publish=now - timedelta(days=i))
+                 for i in range(options['posts'])]
+
+        # The import path builds the thread fields, links the directory and inserts in batches
+        importer = CommentImporter({post.id: post.id for post in posts}, keep_ids=False,
+                                   batch_size=options['batch_size'])
+        for post in posts:
+            for record in self.iter_comments(rng, post, now, options):
+                importer.add(record)
+        importer.flush()
+
+        post_ids = [post.id for post in posts]
+        reconcile_posts(post_ids)
+        recount_authors()
+        for post_id in post_ids:
+            bump_post_generation(post_id)
+        bump_posts_generation()
+        self.stdout.write(f'Seeded {len(posts)} posts with {importer.count} comments '
+                          f'(posts {post_ids[0]}-{post_ids[-1]})' if posts else 'Nothing to seed')
+
+    def iter_comments(self, rng, post, now, options):
+        # Depth first, which is the path order the importer needs; older comments come first
+        per_root = sum(options['fanout'] ** level for level in range(options['depth'] + 1))
+        seconds = options['roots'] * per_root
+        next_id = 0
+        stack = [(None, 0) for _ in range(options['roots'])]
+        while stack:
+            parent_id, depth = stack.pop()
+            next_id += 1
+            user = rng.randrange(options['users'])
+            text = self.words(rng, rng.randint(5, 60))
+            created_at = now - timedelta(seconds=seconds - next_id)
+            yield {
+                'id': next_id, 'post_id': post.id, 'parent_comment_id': parent_id,
+                'user_name': f'user{user}', 'email': f'user{user}@example.com', 'home_page': None, 'captcha': '',
+                'text': text, 'created_at': created_at, 'updated_at': created_at,
+                'reply_count': options['fanout'] if depth < options['depth'] else 0,
+                'image': None, 'image_status': 'ready', 'text_file': None,
+            }
+            if depth < options['depth']:
+                stack.extend((next_id, depth + 1) for _ in range(options['fanout']))
+
+    @staticmethod
+    def words(rng, count):
+        return ' '.join(rng.choice(WORDS) for _ in range(count)).capitalize() + '.'
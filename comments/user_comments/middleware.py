@@ -0,0 +1,89 @@
+import json
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+
+from .instrumentation import RequestTimings, current_timings, finish_request
+
+
+class CommentsGZipMiddleware(GZipMiddleware):
+    # gzip buffers a stream until enough data is written, which would hold back live events
+    def process_response(self, request, response):
+        if response.get('Content-Type', '').startswith('text/event-stream'):
+            return response
+        return super().process_response(request, response)
+
+
+class RequestTimingMiddleware:
+    # Outermost middleware: times the whole request, counts its queries and reports both
+    # as Server-Timing, a log line and (if enabled) /metrics
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return finish_request(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return finish_request(request, response, timings)
+
+
+class RequestBodyLimitMiddleware:
+    # ASGI wrapper around the Django application. Django's ASGI handler spools the whole body to a
+    # file before any view or upload handler runs, so COMMENTS_MAX_UPLOAD_SIZE is enforced here,
+    # before Django reads anything; CommentUploadHandler's own check only helps under WSGI
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        limit = settings.COMMENTS_MAX_UPLOAD_SIZE
+        headers = dict(scope['headers'])
+        try:
+            content_length = int(headers.get(b'content-length', b''))
+        except ValueError:
+            content_length = None
+        if content_length is not None and content_length > limit:
+            body = json.dumps({'success': False, 'message': 'Request is too large'}).encode()
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'application/json'), (b'connection', b'close'),
+                                    (b'content-length', str(len(body)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        received = 0
+
+        async def receive_limited():
+            # A body sent without Content-Length is cut off once it runs over; Django then drops
+            # the request as aborted by the client
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    return {'type': 'http.disconnect'}
+            return message
+
+        return await self.app(scope, receive_limited, send)
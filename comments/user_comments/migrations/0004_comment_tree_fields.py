@@ -0,0 +1,88 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_comment_tree(apps, schema_editor):
+    Comment = apps.get_model("user_comments", "Comment")
+
+    # Walk existing threads top-down, one level per pass
+    parents = {}
+    level = Comment.objects.filter(parent_comment__isnull=True)
+    depth = 0
+    while True:
+        comments = list(level.only("id", "parent_comment_id"))
+        if not comments:
+            break
+        for comment in comments:
+            parent = parents.get(comment.parent_comment_id)
+            comment.depth = depth
+            comment.root_id = parent[0] if parent else comment.id
+            comment.path = (parent[1] if parent else "") + f"{comment.id:010d}/"
+        Comment.objects.bulk_update(
+            comments, ["depth", "root", "path"], batch_size=1000
+        )
+        parents = {comment.id: (comment.root_id, comment.path) for comment in comments}
+        level = Comment.objects.filter(parent_comment_id__in=list(parents))
+        depth += 1
+
+    reply_counts = (
+        Comment.objects.filter(parent_comment__isnull=False)
+        .values("parent_comment_id")
+        .annotate(replies=Count("id"))
+    )
+    for row in reply_counts:
+        Comment.objects.filter(pk=row["parent_comment_id"]).update(
+            reply_count=row["replies"]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0003_rename_parent_comment_parent_comment"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="depth",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Depth"
+            ),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="path",
+            field=models.CharField(
+                db_index=True,
+                default="",
+                editable=False,
+                max_length=2048,
+                verbose_name="Path",
+            ),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="reply_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Reply count"
+            ),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="root",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="thread_comments",
+                to="user_comments.comment",
+                verbose_name="Root Comment",
+            ),
+        ),
+        migrations.RunPython(fill_comment_tree, migrations.RunPython.noop),
+    ]
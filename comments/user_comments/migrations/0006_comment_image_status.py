@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0005_comment_post_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="image_status",
+            field=models.CharField(
+                choices=[
+                    ("ready", "Ready"),
+                    ("processing", "Processing"),
+                    ("failed", "Failed"),
+                ],
+                default="ready",
+                max_length=15,
+                verbose_name="Image status",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                condition=models.Q(("image_status", "processing")),
+                fields=["id"],
+                name="comment_image_queue_idx",
+            ),
+        ),
+    ]
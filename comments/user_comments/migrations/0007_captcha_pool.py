@@ -0,0 +1,48 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0006_comment_image_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CaptchaPoolEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "hashkey",
+                    models.CharField(
+                        max_length=40, unique=True, verbose_name="Hash key"
+                    ),
+                ),
+                ("image", models.BinaryField(verbose_name="PNG image")),
+                ("expiration", models.DateTimeField(verbose_name="Expiration")),
+                ("issued", models.BooleanField(default=False, verbose_name="Issued")),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        condition=models.Q(("issued", False)),
+                        fields=["id"],
+                        name="captcha_pool_free_idx",
+                    ),
+                    models.Index(
+                        fields=["expiration"], name="captcha_pool_expiration_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
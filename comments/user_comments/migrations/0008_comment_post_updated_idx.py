@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0007_captcha_pool"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["post", "updated_at", "id"], name="comment_post_updated_idx"
+            ),
+        ),
+    ]
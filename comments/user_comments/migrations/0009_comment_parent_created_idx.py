@@ -0,0 +1,20 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0008_comment_post_updated_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["parent_comment", "created_at", "id"],
+                name="comment_parent_created_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+
+
+def fill_user_directory(apps, schema_editor):
+    Comment = apps.get_model("user_comments", "Comment")
+    UserInfo = apps.get_model("user_comments", "UserInfo")
+
+    # Racing get_or_create calls left duplicates behind; keep the oldest row of each pair
+    duplicates = (
+        UserInfo.objects.values("user_name", "email")
+        .annotate(keep=Min("id"), rows=Count("id"))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        UserInfo.objects.filter(user_name=row["user_name"], email=row["email"]).exclude(
+            pk=row["keep"]
+        ).delete()
+
+    authors = {(user.user_name, user.email): user for user in UserInfo.objects.all()}
+    stats = Comment.objects.values("user_name", "email").annotate(
+        comments=Count("id"), last=Max("created_at")
+    )
+    for row in stats:
+        user = authors.get((row["user_name"], row["email"]))
+        if user is None:
+            user = UserInfo.objects.create(
+                user_name=row["user_name"], email=row["email"]
+            )
+            authors[(user.user_name, user.email)] = user
+        user.comment_count = row["comments"]
+        user.last_seen = row["last"]
+    UserInfo.objects.bulk_update(
+        authors.values(), ["comment_count", "last_seen"], batch_size=1000
+    )
+
+    for (user_name, email), user in authors.items():
+        Comment.objects.filter(user_name=user_name, email=email).update(author=user)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0010_comment_text_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="author",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="comments",
+                to="user_comments.userinfo",
+                verbose_name="Author",
+            ),
+        ),
+        migrations.AddField(
+            model_name="userinfo",
+            name="comment_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Comment count"
+            ),
+        ),
+        migrations.AddField(
+            model_name="userinfo",
+            name="last_seen",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Last seen"
+            ),
+        ),
+        migrations.RunPython(fill_user_directory, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="userinfo",
+            constraint=models.UniqueConstraint(
+                fields=("user_name", "email"), name="userinfo_user_name_email_uniq"
+            ),
+        ),
+    ]
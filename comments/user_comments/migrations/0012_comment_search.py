@@ -0,0 +1,92 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:33
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+POSTGRESQL_SEARCH_SQL = """
+CREATE FUNCTION user_comments_comment_search_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.text, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.user_name, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER user_comments_comment_search_trigger
+    BEFORE INSERT OR UPDATE OF text, user_name ON user_comments_comment
+    FOR EACH ROW EXECUTE FUNCTION user_comments_comment_search_update();
+
+UPDATE user_comments_comment SET text = text;
+
+CREATE INDEX comment_search_vector_idx ON user_comments_comment USING gin (search_vector);
+"""
+
+POSTGRESQL_SEARCH_REVERSE_SQL = """
+DROP INDEX comment_search_vector_idx;
+DROP TRIGGER user_comments_comment_search_trigger ON user_comments_comment;
+DROP FUNCTION user_comments_comment_search_update();
+"""
+
+# An external content FTS5 table over the comments. The triggers belong to the comment
+# table, so a later migration that makes SQLite rebuild that table has to recreate them
+SQLITE_SEARCH_SQL = [
+    "CREATE VIRTUAL TABLE user_comments_comment_fts USING fts5("
+    "user_name, text, content='user_comments_comment', content_rowid='id')",
+    "CREATE TRIGGER user_comments_comment_fts_insert AFTER INSERT ON user_comments_comment BEGIN "
+    "INSERT INTO user_comments_comment_fts(rowid, user_name, text) "
+    "VALUES (new.id, new.user_name, new.text); END",
+    "CREATE TRIGGER user_comments_comment_fts_delete AFTER DELETE ON user_comments_comment BEGIN "
+    "INSERT INTO user_comments_comment_fts(user_comments_comment_fts, rowid, user_name, text) "
+    "VALUES ('delete', old.id, old.user_name, old.text); END",
+    "CREATE TRIGGER user_comments_comment_fts_update AFTER UPDATE OF user_name, text "
+    "ON user_comments_comment BEGIN "
+    "INSERT INTO user_comments_comment_fts(user_comments_comment_fts, rowid, user_name, text) "
+    "VALUES ('delete', old.id, old.user_name, old.text); "
+    "INSERT INTO user_comments_comment_fts(rowid, user_name, text) "
+    "VALUES (new.id, new.user_name, new.text); END",
+    "INSERT INTO user_comments_comment_fts(user_comments_comment_fts) VALUES ('rebuild')",
+]
+
+SQLITE_SEARCH_REVERSE_SQL = [
+    "DROP TRIGGER user_comments_comment_fts_insert",
+    "DROP TRIGGER user_comments_comment_fts_delete",
+    "DROP TRIGGER user_comments_comment_fts_update",
+    "DROP TABLE user_comments_comment_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_SEARCH_SQL)
+    elif vendor == "sqlite":
+        for sql in SQLITE_SEARCH_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_SEARCH_REVERSE_SQL)
+    elif vendor == "sqlite":
+        for sql in SQLITE_SEARCH_REVERSE_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0011_userinfo_directory"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                blank=True, editable=False, null=True, verbose_name="Search vector"
+            ),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:36
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def fill_post_counters(apps, schema_editor):
+    Comment = apps.get_model("user_comments", "Comment")
+    Post = apps.get_model("user_comments", "Post")
+
+    stats = (
+        Comment.objects.order_by()
+        .values("post_id")
+        .annotate(comments=Count("id"), last=Max("created_at"))
+    )
+    roots = dict(
+        Comment.objects.filter(parent_comment__isnull=True)
+        .order_by()
+        .values_list("post_id")
+        .annotate(Count("id"))
+    )
+    for row in stats:
+        Post.objects.filter(pk=row["post_id"]).update(
+            comment_count=row["comments"],
+            root_count=roots.get(row["post_id"], 0),
+            last_comment_at=row["last"],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_comments", "0012_comment_search"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="comment_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Comments"
+            ),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="last_comment_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Last comment at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="root_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Root comments"
+            ),
+        ),
+        migrations.RunPython(fill_post_counters, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,13 @@
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
 
+from .sanitizer import sanitize_text, text_digest
+
 
 class Post(models.Model):
     STATUS_CHOICES = (('draft', 'Draft'), ('published', 'Published'))
@@ -16,40 +21,161 @@ class Post(models.Model):
     updated = models.DateTimeField(auto_now=True, verbose_name="Updated at")
     status = models.CharField(max_length=15, choices=STATUS_CHOICES, default='draft')
 
+    # Comment statistics, kept by F() updates on comment create and delete; see reconcile_post_counters
+    comment_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Comments")
+    root_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Root comments")
+    last_comment_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Last comment at")
+
+    COUNTER_FIELDS = ('comment_count', 'root_count', 'last_comment_at')
+
+    def save(self, *args, **kwargs):
+        # A loaded post must not write its possibly stale counters back over concurrent updates
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.COUNTER_FIELDS]
+        super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('user_comments:post_detail', args=[self.publish.year, self.publish.strftime('%m'),
                                                           self.publish.strftime('%d'), self.id])
 
     class Meta:
         ordering = ('-publish',)
+        indexes = [
+            models.Index(fields=['status', 'publish'], name='post_status_publish_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
 
 class Comment(models.Model):
+    IMAGE_STATUS_CHOICES = (('ready', 'Ready'), ('processing', 'Processing'), ('failed', 'Failed'))
     user_name = models.CharField(max_length=255, verbose_name="User Name", default='user')
     email = models.EmailField(unique=False, verbose_name="E-mail")
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
     home_page = models.URLField(blank=True, null=True, verbose_name="Home page")
     captcha = models.CharField(max_length=48, verbose_name="CAPTCHA", default='')
     text = models.TextField(verbose_name="Comment Text")
+    # Digest of the sanitized text; a mismatch means the text still has to go through the sanitizer
+    text_hash = models.CharField(max_length=64, blank=True, default='', editable=False, verbose_name="Text hash")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Created at")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Updated at")
+    # Weighted text and user name, kept by a database trigger on PostgreSQL (GIN indexed);
+    # SQLite indexes the same columns in an FTS5 table instead and leaves this empty
+    search_vector = SearchVectorField(null=True, blank=True, editable=False, verbose_name="Search vector")
+
+    # The author's row in the UserInfo directory; user_name and email stay on the comment for reading
+    author = models.ForeignKey('UserInfo', on_delete=models.SET_NULL, null=True, blank=True, editable=False,
+                               related_name='comments', verbose_name="Author")
 
     parent_comment = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True,
                                        related_name='replies', verbose_name="Parent Comment")
 
+    # Denormalized thread structure, maintained on insert
+    root = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, editable=False,
+                             related_name='thread_comments', verbose_name="Root Comment")
+    path = models.CharField(max_length=2048, default='', editable=False, db_index=True, verbose_name="Path")
+    depth = models.PositiveIntegerField(default=0, editable=False, verbose_name="Depth")
+    reply_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Reply count")
+
     image = models.ImageField(upload_to='images/', blank=True, null=True, verbose_name="Image")
+    image_status = models.CharField(max_length=15, choices=IMAGE_STATUS_CHOICES, default='ready',
+                                    verbose_name="Image status")
     text_file = models.FileField(upload_to='text_files/', blank=True, null=True, verbose_name="Text File")
 
     class Meta:
         ordering = ['-created_at']
+        # One index per sort mode of the comments API, plus the root/reply split
+        indexes = [
+            models.Index(fields=['post', 'created_at', 'id'], name='comment_post_created_idx'),
+            models.Index(fields=['post', 'user_name', 'id'], name='comment_post_user_name_idx'),
+            models.Index(fields=['post', 'email', 'id'], name='comment_post_email_idx'),
+            models.Index(fields=['post', 'parent_comment'], name='comment_post_parent_idx'),
+            # Replies of one comment, paged in date order
+            models.Index(fields=['parent_comment', 'created_at', 'id'], name='comment_parent_created_idx'),
+            # ?since= reads the changes of a post in this order
+            models.Index(fields=['post', 'updated_at', 'id'], name='comment_post_updated_idx'),
+            # Comments waiting for a thumbnail are the image processing queue
+            models.Index(fields=['id'], condition=models.Q(image_status='processing'),
+                         name='comment_image_queue_idx'),
+        ]
 
     def __str__(self):
         return f"Comment by {self.user_name} on {self.created_at}"
 
+    def clean(self):
+        super().clean()
+        if self.text and not sanitize_text(self.text)[1]:
+            raise ValidationError({'text': 'Invalid XHTML markup'})
+
+    def sanitize(self):
+        # Whatever the way in (API, admin, shell), only sanitized text is stored
+        if self.text_hash != text_digest(self.text):
+            self.text = sanitize_text(self.text)[0]
+            self.text_hash = text_digest(self.text)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'text' in update_fields:
+            self.sanitize()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'text_hash'}
+
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        # Joins the caller's transaction without a savepoint of its own
+        with transaction.atomic(savepoint=False):
+            parent = self.parent_comment
+            self.depth = parent.depth + 1 if parent else 0
+            super().save(*args, **kwargs)
+
+            # The path is built from ids, so it can only be written once the row exists
+            self.root_id = parent.root_id if parent else self.id
+            self.path = (parent.path if parent else '') + path_segment(self.id)
+            Comment.objects.filter(pk=self.pk).update(root_id=self.root_id, path=self.path)
+            if parent:
+                Comment.objects.filter(pk=parent.pk).update(reply_count=F('reply_count') + 1)
+            Post.objects.filter(pk=self.post_id).update(comment_count=F('comment_count') + 1,
+                                                        root_count=F('root_count') + (0 if parent else 1),
+                                                        last_comment_at=self.created_at)
+
+    def get_descendants(self):
+        # The whole subtree is one prefix range over the indexed path, in thread order
+        return Comment.objects.filter(path__startswith=self.path, depth__gt=self.depth).order_by('path')
+
+
+def path_segment(comment_id):
+    # Fixed-width segments make the lexical order of paths match the thread order
+    return f'{comment_id:010d}/'
+
 
 class UserInfo(models.Model):
+    # One row per (user_name, email) pair that has commented, upserted with every new comment
     user_name = models.CharField(max_length=255, verbose_name="User Name", default='user')
     email = models.EmailField(unique=False, verbose_name="E-mail")
+    comment_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Comment count")
+    last_seen = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Last seen")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_name', 'email'], name='userinfo_user_name_email_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_name} <{self.email}>"
+
+
+class CaptchaPoolEntry(models.Model):
+    # A pre-generated CAPTCHA (its CaptchaStore row shares the hashkey) with the image already rendered
+    hashkey = models.CharField(max_length=40, unique=True, verbose_name="Hash key")
+    image = models.BinaryField(verbose_name="PNG image")
+    expiration = models.DateTimeField(verbose_name="Expiration")
+    issued = models.BooleanField(default=False, verbose_name="Issued")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(issued=False), name='captcha_pool_free_idx'),
+            models.Index(fields=['expiration'], name='captcha_pool_expiration_idx'),
+        ]
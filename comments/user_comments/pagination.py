@@ -0,0 +1,41 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+
+
+# Fields whose cursor values have to be converted back from strings
+DATETIME_FIELDS = {'created_at', 'updated_at'}
+
+
+def encode_cursor(ordering, row):
+    # The cursor remembers the sort key so it can't be replayed against another ordering
+    field = ordering[0].lstrip('-')
+    value = row[field]
+    if field in DATETIME_FIELDS:
+        value = value.isoformat()
+    payload = json.dumps([ordering[0], value, row['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(ordering, cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key, value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if key != ordering[0]:
+            raise ValueError('Cursor belongs to another ordering')
+        if key.lstrip('-') in DATETIME_FIELDS:
+            value = datetime.fromisoformat(value)
+        return value, int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise NotFound('Invalid cursor')
+
+
+def keyset_filter(ordering, value, pk):
+    # (field, id) > (value, pk) spelled so that the (field, id) index can be used for the range
+    field = ordering[0].lstrip('-')
+    op = 'lt' if ordering[0].startswith('-') else 'gt'
+    return (Q(**{f'{field}__{op}e': value}) &
+            (Q(**{f'{field}__{op}': value}) | Q(**{f'id__{op}': pk})))
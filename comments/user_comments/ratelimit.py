@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Refill and take one token in a single atomic step; the wait is returned as a string
+# because Redis truncates Lua numbers to integers
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+# The local buckets are pruned once there are this many
+LOCAL_BUCKETS_LIMIT = 10000
+
+
+class LocalTokenBuckets:
+    # Per-process fallback without Redis; every worker then allows the full rate on its own
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self.lock:
+            tokens, ts = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            wait = (1 - tokens) / rate if tokens < 1 else 0
+            self.buckets[key] = (tokens if wait else tokens - 1, now)
+            if len(self.buckets) > LOCAL_BUCKETS_LIMIT:
+                self.prune(now, capacity, rate)
+        return wait
+
+    def prune(self, now, capacity, rate):
+        # Buckets that have refilled completely hold no state worth keeping
+        self.buckets = {key: (tokens, ts) for key, (tokens, ts) in self.buckets.items()
+                        if tokens + (now - ts) * rate < capacity}
+
+
+class RedisTokenBuckets:
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.fallback = LocalTokenBuckets()
+
+    def take(self, key, capacity, rate):
+        try:
+            return float(self.script(keys=[key], args=[capacity, rate]))
+        except redis.RedisError:
+            # Keep limiting, if only per process, while Redis is unreachable
+            logger.warning('Rate limiting through Redis failed', exc_info=True)
+            return self.fallback.take(key, capacity, rate)
+
+
+buckets = None
+
+
+def get_buckets():
+    global buckets
+    if buckets is None:
+        buckets = RedisTokenBuckets(settings.REDIS_URL) if settings.REDIS_URL else LocalTokenBuckets()
+    return buckets
+
+
+def take_token(scope, ident):
+    # Returns 0 when the request may go on, otherwise the seconds until the next token
+    capacity, rate = settings.COMMENTS_RATE_LIMITS[scope]
+    return get_buckets().take(f'comments:ratelimit:{scope}:{ident}', capacity, rate)
+
+
+def get_client_ip(request):
+    # Behind N trusted proxies the client is the Nth address from the right of X-Forwarded-For;
+    # the entries left of it are whatever the client sent and can't be trusted
+    proxies = settings.COMMENTS_TRUSTED_PROXIES
+    if proxies:
+        forwarded = [address.strip() for address in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        forwarded = [address for address in forwarded if address]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
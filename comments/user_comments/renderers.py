@@ -0,0 +1,23 @@
+import msgpack
+from rest_framework.renderers import BaseRenderer
+
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+
+class MessagePackRenderer(BaseRenderer):
+    # Picked with `Accept: application/msgpack` (or ?format=msgpack)
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True)
+
+
+def accepts_msgpack(request):
+    # Content negotiation for the plain async views, which don't go through DRF
+    return MSGPACK_MEDIA_TYPE in request.headers.get('Accept', '') or request.GET.get('format') == 'msgpack'
@@ -0,0 +1,55 @@
+import hashlib
+import threading
+from functools import lru_cache
+
+from bleach.sanitizer import Cleaner
+from django.conf import settings
+from lxml import etree
+
+
+# Texts up to this length are remembered, so a burst of identical submissions is cleaned once
+SANITIZE_CACHE_SIZE = 4096
+SANITIZE_CACHE_MAX_LENGTH = 8192
+
+local = threading.local()
+
+
+def get_cleaner():
+    # Building the cleaner and its html5lib parser is most of what bleach.clean() costs;
+    # the parser keeps state while it runs, so every thread gets its own
+    cleaner = getattr(local, 'cleaner', None)
+    if cleaner is None:
+        cleaner = local.cleaner = Cleaner(tags=settings.BLEACH_ALLOWED_TAGS,
+                                          attributes=settings.BLEACH_ALLOWED_ATTRIBUTES)
+    return cleaner
+
+
+def is_well_formed(html):
+    # The allowed markup also has to be valid XHTML
+    try:
+        etree.fromstring("<root>" + html + "</root>")
+        return True
+    except etree.XMLSyntaxError:
+        return False
+
+
+def clean_text(text):
+    html = get_cleaner().clean(text)
+    return html, is_well_formed(html)
+
+
+@lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def clean_text_cached(text):
+    return clean_text(text)
+
+
+def sanitize_text(text):
+    # Returns the cleaned HTML and whether it is well-formed
+    if len(text) <= SANITIZE_CACHE_MAX_LENGTH:
+        return clean_text_cached(text)
+    return clean_text(text)
+
+
+def text_digest(text):
+    # Stored with the comment: a matching digest means the text is the sanitizer's output
+    return hashlib.sha256(text.encode()).hexdigest()
@@ -0,0 +1,90 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from rest_framework.exceptions import ParseError
+
+from .models import Comment
+from .serializers import COMMENT_VALUES, serialize_comment_rows
+
+
+# Text search configuration the search_vector trigger of migration 0012 uses on PostgreSQL
+SEARCH_CONFIG = 'english'
+
+# FTS5 table of the same columns, kept by triggers on SQLite
+FTS_TABLE = 'user_comments_comment_fts'
+
+COMMENTS_SEARCH_LIMIT = 20
+COMMENTS_SEARCH_MAX_LENGTH = 200
+
+# Thread context sent with each hit: the root comment plus the nearest ancestors, this many in all
+COMMENTS_SEARCH_CONTEXT = 3
+
+
+def fts_match_expression(query):
+    # Every word becomes a quoted FTS5 string, so user input can't break the MATCH syntax
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def get_search_query(query):
+    return SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+
+
+def comment_search_filter(query):
+    # Comments whose text or user name match, through the full-text index of the database
+    if connection.vendor == 'postgresql':
+        return Q(search_vector=get_search_query(query))
+    if connection.vendor == 'sqlite':
+        return Q(id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+                               [fts_match_expression(query)]))
+    return Q(text__icontains=query) | Q(user_name__icontains=query)
+
+
+def comment_search_rank(query):
+    # Higher is better on every backend; the user name weighs less than the text
+    if connection.vendor == 'postgresql':
+        return SearchRank(F('search_vector'), get_search_query(query))
+    if connection.vendor == 'sqlite':
+        return RawSQL(f'SELECT -bm25({FTS_TABLE}, 0.4, 1.0) FROM {FTS_TABLE} '
+                      f'WHERE {FTS_TABLE} MATCH %s AND rowid = user_comments_comment.id',
+                      [fts_match_expression(query)], output_field=FloatField())
+    return Value(0.0)
+
+
+def get_context_ids(path):
+    # Ancestor ids from the materialized path, root first, without the comment itself
+    ids = [int(segment) for segment in path.split('/') if segment][:-1]
+    if len(ids) > COMMENTS_SEARCH_CONTEXT:
+        ids = ids[:1] + ids[1 - COMMENTS_SEARCH_CONTEXT:]
+    return ids
+
+
+def search_comments(params):
+    query = params.get('q', '').strip()
+    if not query:
+        raise ParseError('Search query is required')
+    if len(query) > COMMENTS_SEARCH_MAX_LENGTH:
+        raise ParseError('Search query is too long')
+
+    comments = Comment.objects.filter(comment_search_filter(query), post__status='published')
+    post_id = params.get('post')
+    if post_id:
+        try:
+            comments = comments.filter(post_id=int(post_id))
+        except ValueError:
+            raise ParseError('Invalid post')
+
+    rows = list(comments.annotate(rank=comment_search_rank(query)).order_by('-rank', '-id')
+                .values(*COMMENT_VALUES, 'rank')[:COMMENTS_SEARCH_LIMIT])
+
+    # The thread context of all hits is fetched in one query
+    context_ids = {row['id']: get_context_ids(row['path']) for row in rows}
+    wanted = {comment_id for ids in context_ids.values() for comment_id in ids}
+    context_rows = Comment.objects.filter(id__in=wanted).values(*COMMENT_VALUES) if wanted else []
+    context = {comment['id']: comment for comment in serialize_comment_rows(context_rows)}
+
+    hits = serialize_comment_rows(rows)
+    for hit, row in zip(hits, rows):
+        hit['rank'] = row['rank']
+        hit['context'] = [context[comment_id] for comment_id in context_ids[row['id']] if comment_id in context]
+    return {'query': query, 'comments': hits}
@@ -1,3 +1,4 @@
+from django.utils import timezone
 from rest_framework import serializers
 from .models import Comment, Post
 
@@ -11,4 +12,67 @@ class PostSerializer(serializers.ModelSerializer):
 class CommentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
-        fields = '__all__'
+        exclude = ['text_hash', 'search_vector', 'author']
+
+
+# Read-only fast path: builds the same JSON as CommentSerializer straight from .values() rows
+
+COMMENT_DATE_FORMAT = "%H:%M %d.%m.%Y"
+
+COMMENT_VALUES = (
+    'id', 'user_name', 'email', 'home_page', 'captcha', 'text', 'created_at', 'updated_at', 'path', 'depth',
+    'reply_count', 'image', 'image_status', 'text_file', 'post_id', 'parent_comment_id', 'root_id',
+)
+
+
+def format_datetime(value):
+    # Same output as DRF's DateTimeField with the default ISO 8601 format
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def serialize_comment_row(row, image_storage, text_file_storage):
+    # Keys and order match CommentSerializer; foreign keys are emitted under the field name
+    return {
+        'id': row['id'],
+        'user_name': row['user_name'],
+        'email': row['email'],
+        'home_page': row['home_page'],
+        'captcha': row['captcha'],
+        'text': row['text'],
+        'created_at': row['created_at'].strftime(COMMENT_DATE_FORMAT),
+        'updated_at': format_datetime(row['updated_at']),
+        'path': row['path'],
+        'depth': row['depth'],
+        'reply_count': row['reply_count'],
+        'image': image_storage.url(row['image']) if row['image'] else None,
+        'image_status': row['image_status'],
+        'text_file': text_file_storage.url(row['text_file']) if row['text_file'] else None,
+        'post': row['post_id'],
+        'parent_comment': row['parent_comment_id'],
+        'root': row['root_id'],
+    }
+
+
+def serialize_comment_rows(rows):
+    image_storage = Comment._meta.get_field('image').storage
+    text_file_storage = Comment._meta.get_field('text_file').storage
+    return [serialize_comment_row(row, image_storage, text_file_storage) for row in rows]
+
+
+def flatten_comment_tree(comments):
+    # Columnar layout: key names once, one value list per node in tree order,
+    # and the index of each node's parent in `rows` (-1 for the top level)
+    fields = [key for key in comments[0] if key != 'children'] if comments else []
+    rows = []
+    parents = []
+    stack = [(data, -1) for data in reversed(comments)]
+    while stack:
+        data, parent = stack.pop()
+        parents.append(parent)
+        rows.append([data[key] for key in fields])
+        index = len(rows) - 1
+        stack.extend((child, index) for child in reversed(data.get('children', ())))
+    return {'fields': fields, 'rows': rows, 'parents': parents}
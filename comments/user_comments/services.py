@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import math
+
+from asgiref.sync import sync_to_async
+from captcha.models import CaptchaStore
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .forms import CommentForm
+from .images import enqueue_image_processing
+from .instrumentation import span
+from .models import Post, Comment, UserInfo
+from .ratelimit import take_token
+from .sanitizer import sanitize_text, text_digest
+
+
+logger = logging.getLogger(__name__)
+
+
+class CommentError(Exception):
+    # A comment rejected by the create pipeline, reported to the client as-is
+    def __init__(self, message, status=400, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+
+def check_rate_limit(scope, ident):
+    wait = take_token(scope, ident)
+    if wait:
+        raise CommentError('Too many comments, please try again later', status=429,
+                           retry_after=math.ceil(wait))
+
+
+def submission_key(post_id, data):
+    values = [str(post_id), data.get('parent_comment') or '', data.get('email', '').strip().lower(),
+              data.get('text', '')]
+    digest = hashlib.sha256(json.dumps(values).encode()).hexdigest()
+    return f'comments:submission:{digest}'
+
+
+def claim_submission(post_id, data):
+    # Cheap checks on the raw fields, ahead of form validation, image decoding and sanitizing
+    email = data.get('email', '').strip().lower()
+    if email:
+        check_rate_limit('email', email)
+
+    # The same comment posted again within the window (double submit, replayed request) is dropped
+    key = submission_key(post_id, data)
+    if not cache.add(key, True, settings.COMMENTS_DUPLICATE_WINDOW):
+        raise CommentError('Duplicate comment', status=409)
+    return key
+
+
+def save_user_info(user_name, email):
+    # One statement, race-free under the unique constraint: add the author or count one more comment
+    table = connection.ops.quote_name(UserInfo._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (user_name, email, comment_count, last_seen) VALUES (%s, %s, 1, %s) '
+            f'ON CONFLICT (user_name, email) DO UPDATE '
+            f'SET comment_count = {table}.comment_count + 1, last_seen = EXCLUDED.last_seen '
+            f'RETURNING id',
+            [user_name, email, connection.ops.adapt_datetimefield_value(timezone.now())])
+        return cursor.fetchone()[0]
+
+
+def get_form_error_message(form):
+    errors = form.errors.as_json()
+    errors_dict = json.loads(errors)  # Convert JSON string to a dictionary
+
+    # Check if the 'image' key is in the dictionary
+    if "image" in errors_dict:
+        return errors_dict["image"][0]["message"]
+    # If the 'image' field has no errors, display a general message or another field
+    return list(errors_dict.values())[0][0]["message"]  # Get the message from the first field with an error
+
+
+def consume_captcha(captcha_key, captcha_value):
+    # One DELETE both checks the answer and makes the key single-use
+    deleted, _ = CaptchaStore.objects.filter(hashkey=captcha_key, response=captcha_value,
+                                             expiration__gt=timezone.now()).delete()
+    if not deleted:
+        raise CommentError('Incorrect CAPTCHA')
+
+
+def get_post_and_parent(post_id, parent_id):
+    # A reply is looked up together with its post, so the parent has to belong to the same post
+    if parent_id:
+        try:
+            parent_id = int(parent_id)
+        except (TypeError, ValueError):
+            raise CommentError('Parent comment not found', status=404)
+        parent_comment = Comment.objects.select_related('post').filter(id=parent_id, post_id=post_id).first()
+        if parent_comment is None:
+            raise CommentError('Parent comment not found', status=404)
+        return parent_comment.post, parent_comment
+
+    post = Post.objects.filter(id=post_id).first()
+    if post is None:
+        raise CommentError('Post not found', status=404)
+    return post, None
+
+
+def prepare_comment(form, files, captcha_value):
+    # CPU-bound part of the pipeline: no database access, safe to run in a worker thread
+    comment = form.save(commit=False)
+
+    # Add a CAPTCHA value to the comment
+    comment.captcha = captcha_value
+
+    # Clean the comment text from unwanted tags and check that the rest is valid XHTML
+    with span('sanitize'):
+        comment.text, well_formed = sanitize_text(comment.text)
+    if not well_formed:
+        raise CommentError('Invalid XHTML markup')
+    comment.text_hash = text_digest(comment.text)
+
+    # The original upload is stored now, the thumbnail is made in the background
+    image_tmp_file = files.get('image')
+    if image_tmp_file:
+        valid_formats = ['image/jpeg', 'image/png', 'image/gif']
+        if image_tmp_file.content_type not in valid_formats:
+            raise CommentError('Invalid image format')
+        comment.image = image_tmp_file
+        comment.image_status = 'processing'
+
+    # Handle text file processing
+    try:
+        file_tmp_file = files.get('file')
+        if file_tmp_file:
+            if not file_tmp_file.name.endswith('.txt'):
+                raise CommentError('Invalid file format. Only .txt files are allowed.')
+            if file_tmp_file.size > settings.COMMENTS_MAX_TEXT_FILE_SIZE:  # 100 KB
+                raise CommentError('File is too large')
+
+            comment.text_file = file_tmp_file
+            new_name = comment.text_file.name.split('/')[-1]
+            comment.text_file.name = new_name
+    except CommentError:
+        raise
+    except Exception:
+        logger.exception('Attaching the text file of a comment failed')
+
+    return comment
+
+
+def save_comment(comment, captcha_key, post_id, parent_id):
+    # Every database step of the create path runs in one short transaction:
+    # captcha DELETE, post/parent SELECT, user upsert and the insert itself
+    with transaction.atomic():
+        consume_captcha(captcha_key, comment.captcha)
+        comment.post, comment.parent_comment = get_post_and_parent(post_id, parent_id)
+
+        # Save user information before saving the comment
+        comment.author_id = save_user_info(comment.user_name, comment.email)
+
+        comment.save()
+        if comment.image_status == 'processing':
+            enqueue_image_processing(comment)
+    return comment
+
+
+def create_comment(data, files, post_id):
+    submission = claim_submission(post_id, data)
+    try:
+        # Create a comment form; validation includes decoding an uploaded image
+        form = CommentForm(data, files)
+        with span('form'):
+            valid = form.is_valid()
+        if not valid:
+            raise CommentError(get_form_error_message(form))
+
+        comment = prepare_comment(form, files, data.get('captcha_value', ''))
+        with span('save'):
+            return save_comment(comment, data.get('captcha_key', ''), post_id, data.get('parent_comment'))
+    except Exception:
+        # A rejected comment may be corrected and sent again right away
+        cache.delete(submission)
+        raise
+
+
+async def acreate_comment(data, files, post_id):
+    submission = await sync_to_async(claim_submission)(post_id, data)
+    try:
+        # Form validation decodes uploaded images, so it runs in the thread pool
+        form = CommentForm(data, files)
+        with span('form'):
+            valid = await sync_to_async(form.is_valid, thread_sensitive=False)()
+        if not valid:
+            raise CommentError(get_form_error_message(form))
+
+        # bleach and lxml don't need the event loop
+        comment = await sync_to_async(prepare_comment, thread_sensitive=False)(
+            form, files, data.get('captcha_value', ''))
+
+        # The transaction has to stay on one connection, so the database part runs as a single sync call
+        with span('save'):
+            return await sync_to_async(save_comment)(comment, data.get('captcha_key', ''), post_id,
+                                                     data.get('parent_comment'))
+    except Exception:
+        await cache.adelete(submission)
+        raise
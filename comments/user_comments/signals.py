@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models import Case, F, OuterRef, Subquery, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import bump_post_generation, bump_posts_generation
+from .events import publish_new_comment
+from .models import Post, Comment, UserInfo
+
+
+@receiver(post_delete, sender=Comment)
+def decrement_reply_count(sender, instance, **kwargs):
+    # Keep the parent's reply counter in step with deleted replies
+    if instance.parent_comment_id:
+        Comment.objects.filter(pk=instance.parent_comment_id).update(reply_count=F('reply_count') - 1)
+
+
+@receiver(post_delete, sender=Comment)
+def decrement_post_counters(sender, instance, **kwargs):
+    # last_comment_at is only recomputed when the latest comment goes, in the same UPDATE
+    latest = (Comment.objects.filter(post=OuterRef('pk')).order_by('-created_at').values('created_at')[:1])
+    Post.objects.filter(pk=instance.post_id).update(
+        comment_count=F('comment_count') - 1,
+        root_count=F('root_count') - (0 if instance.parent_comment_id else 1),
+        last_comment_at=Case(When(last_comment_at__lte=instance.created_at, then=Subquery(latest)),
+                             default=F('last_comment_at')))
+
+
+@receiver(post_delete, sender=Comment)
+def decrement_comment_count(sender, instance, **kwargs):
+    if instance.author_id:
+        UserInfo.objects.filter(pk=instance.author_id).update(comment_count=F('comment_count') - 1)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_pages(sender, instance, **kwargs):
+    # Bump after commit, so no reader can cache the old state under the new generation
+    post_id = instance.post_id
+    transaction.on_commit(lambda: bump_post_generation(post_id))
+
+    # New and deleted comments also change the counts on the post listing
+    if kwargs.get('created', True):
+        transaction.on_commit(bump_posts_generation)
+
+
+@receiver(post_save, sender=Comment)
+def push_new_comment(sender, instance, created, **kwargs):
+    # Sent after commit, when save() has also filled in the thread fields
+    if created:
+        transaction.on_commit(lambda: publish_new_comment(instance))
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post_pages(sender, instance, **kwargs):
+    # The post itself is part of every cached comments page and ETag, and of the post listing
+    post_id = instance.id
+
+    def bump():
+        bump_post_generation(post_id)
+        bump_posts_generation()
+    transaction.on_commit(bump)
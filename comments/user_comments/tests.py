@@ -0,0 +1,41 @@
+from captcha.models import CaptchaStore
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from .models import Comment, Post
+from .sanitizer import text_digest
+from .services import save_comment
+
+
+class SaveCommentQueriesTest(TestCase):
+    # The create path is a fixed number of round trips; a new query here is a regression
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create(username='author')
+        cls.post = Post.objects.create(title='Post', author=author, body='Body', status='published')
+
+    def make_comment(self, text):
+        key = CaptchaStore.generate_key()
+        comment = Comment(user_name='user', email='user@example.com', text=text, text_hash=text_digest(text),
+                          captcha=CaptchaStore.objects.get(hashkey=key).response)
+        return comment, key
+
+    def test_root_comment(self):
+        comment, key = self.make_comment('Root comment')
+        # SAVEPOINT, captcha DELETE, post SELECT, user upsert, comment INSERT,
+        # path UPDATE, post counters UPDATE, RELEASE SAVEPOINT
+        with self.assertNumQueries(8):
+            save_comment(comment, key, self.post.id, None)
+        self.assertEqual(comment.root_id, comment.id)
+
+    def test_reply(self):
+        parent, key = self.make_comment('Root comment')
+        save_comment(parent, key, self.post.id, None)
+
+        comment, key = self.make_comment('Reply')
+        # SAVEPOINT, captcha DELETE, parent and post SELECT, user upsert, comment INSERT,
+        # path UPDATE, parent reply_count UPDATE, post counters UPDATE, RELEASE SAVEPOINT
+        with self.assertNumQueries(9):
+            save_comment(comment, key, self.post.id, parent.id)
+        self.assertEqual(comment.parent_comment_id, parent.id)
+        self.assertEqual(comment.root_id, parent.id)
@@ -0,0 +1,250 @@
+import datetime
+import json
+from contextlib import contextmanager
+
+import msgpack
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_datetime
+
+from .models import Comment, Post, UserInfo, path_segment
+
+
+# Export stream: one record per post, then per directory entry, then per comment. Comments come
+# post by post in thread order, so a parent is always read before its replies; the tree fields
+# (root, path, depth) are rebuilt on import from the parent links. text_hash is left out: it only
+# vouches for text this database sanitized, so imported text is always sanitized again
+POST_FIELDS = ('id', 'title', 'body', 'publish', 'published', 'created', 'updated', 'status')
+USER_FIELDS = ('user_name', 'email')
+COMMENT_FIELDS = (
+    'id', 'post_id', 'parent_comment_id', 'user_name', 'email', 'home_page', 'captcha', 'text', 'created_at',
+    'updated_at', 'reply_count', 'image', 'image_status', 'text_file',
+)
+DATETIME_FIELDS = {'publish', 'created', 'updated', 'created_at', 'updated_at'}
+
+TRANSFER_FORMATS = ('ndjson', 'msgpack')
+
+
+def guess_format(path):
+    return 'msgpack' if path.endswith(('.msgpack', '.mpk')) else 'ndjson'
+
+
+class TransferError(Exception):
+    pass
+
+
+def encode_record(record_type, row):
+    record = {'type': record_type}
+    for name, value in row.items():
+        record[name] = value.isoformat() if isinstance(value, datetime.datetime) else value
+    return record
+
+
+def decode_datetimes(record):
+    for name in DATETIME_FIELDS.intersection(record):
+        if record[name] is not None:
+            record[name] = parse_datetime(record[name])
+    return record
+
+
+def get_record_writer(stream, fmt):
+    if fmt == 'msgpack':
+        packer = msgpack.Packer(use_bin_type=True)
+        return lambda record: stream.write(packer.pack(record))
+    return lambda record: stream.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+
+
+def read_records(stream, fmt):
+    # Streams records off the file, whatever its size
+    if fmt == 'msgpack':
+        yield from msgpack.Unpacker(stream, raw=False)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def export_comments(write, post_ids=None, chunk_size=2000):
+    posts = Post.objects.order_by('id')
+    users = UserInfo.objects.order_by('id')
+    if post_ids:
+        posts = posts.filter(id__in=post_ids)
+        users = users.filter(comments__post_id__in=post_ids).distinct()
+
+    exported_post_ids = []
+    for row in posts.values(*POST_FIELDS, 'author__username'):
+        # Users are matched by username on import
+        row['author'] = row.pop('author__username')
+        write(encode_record('post', row))
+        exported_post_ids.append(row['id'])
+    for row in users.values(*USER_FIELDS).iterator(chunk_size=chunk_size):
+        write(encode_record('user', row))
+
+    count = 0
+    for post_id in exported_post_ids:
+        comments = Comment.objects.filter(post_id=post_id).order_by('path').values(*COMMENT_FIELDS)
+        for row in comments.iterator(chunk_size=chunk_size):
+            write(encode_record('comment', row))
+            count += 1
+    return len(exported_post_ids), count
+
+
+@contextmanager
+def keep_timestamps():
+    # bulk_create would stamp auto_now(_add) fields with the current time; imports keep the exported ones
+    fields = [Post._meta.get_field(name) for name in ('created', 'updated')]
+    fields += [Comment._meta.get_field(name) for name in ('created_at', 'updated_at')]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def allocate_ids(model, count):
+    # Ids for rows about to be inserted, so the tree fields can be built before the INSERT
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                           [table, count])
+            return [row[0] for row in cursor.fetchall()]
+        if connection.vendor == 'sqlite':
+            # A single writer; explicitly inserted ids move the AUTOINCREMENT sequence along
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)}')
+            start = cursor.fetchone()[0] + 1
+            return list(range(start, start + count))
+    raise TransferError(f'Importing with new ids is not supported on {connection.vendor}')
+
+
+def reset_sequences(*models):
+    # After inserting explicit ids, so later inserts don't collide with them
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+
+def import_posts(records, keep_ids, default_author=None):
+    # Returns the old id -> new id map of the imported posts
+    authors = dict(User.objects.filter(username__in={record['author'] for record in records})
+                   .values_list('username', 'id'))
+    posts = []
+    for record in records:
+        author_id = authors.get(record['author'], default_author)
+        if author_id is None:
+            raise TransferError(f'No user "{record["author"]}" for post {record["id"]}')
+        fields = {name: record[name] for name in POST_FIELDS if name != 'id'}
+        posts.append(Post(id=record['id'] if keep_ids else None, author_id=author_id, **fields))
+    with keep_timestamps():
+        Post.objects.bulk_create(posts)
+    if keep_ids:
+        reset_sequences(Post)
+    return {record['id']: post.id for record, post in zip(records, posts)}
+
+
+def import_users(records, batch_size):
+    for start in range(0, len(records), batch_size):
+        UserInfo.objects.bulk_create([UserInfo(**record) for record in records[start:start + batch_size]],
+                                     ignore_conflicts=True)
+
+
+def get_author_ids(pairs):
+    # Directory ids of the (user_name, email) pairs of a batch, adding the ones still missing
+    def lookup():
+        return {(user_name, email): pk for pk, user_name, email in UserInfo.objects.filter(
+            email__in={email for _, email in pairs}).values_list('id', 'user_name', 'email')}
+
+    authors = lookup()
+    missing = pairs - authors.keys()
+    if missing:
+        UserInfo.objects.bulk_create([UserInfo(user_name=user_name, email=email) for user_name, email in missing],
+                                     ignore_conflicts=True)
+        authors = lookup()
+    return authors
+
+
+class CommentImporter:
+    # Buffers comment records into bulk INSERTs. Thread fields come from the parents already seen,
+    # which only have to be remembered for the post being read
+    def __init__(self, post_map, keep_ids, batch_size):
+        self.post_map = post_map
+        self.keep_ids = keep_ids
+        self.batch_size = batch_size
+        self.post_id = None
+        self.tree = {}
+        self.batch = []
+        self.count = 0
+
+    def add(self, record):
+        if record['post_id'] != self.post_id:
+            self.flush()
+            self.post_id = record['post_id']
+            self.tree = {}
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        records, self.batch = self.batch, []
+        ids = [record['id'] for record in records] if self.keep_ids else allocate_ids(Comment, len(records))
+        authors = get_author_ids({(record['user_name'], record['email']) for record in records})
+        post_id = self.post_map[self.post_id]
+
+        comments = []
+        for record, comment_id in zip(records, ids):
+            parent_id = record['parent_comment_id']
+            if parent_id is None:
+                parent = None
+                root_id, path, depth = comment_id, path_segment(comment_id), 0
+            else:
+                parent = self.tree.get(parent_id)
+                if parent is None:
+                    raise TransferError(f'Comment {record["id"]} comes before its parent {parent_id}')
+                root_id, path, depth = parent[1], parent[2] + path_segment(comment_id), parent[3] + 1
+            self.tree[record['id']] = (comment_id, root_id, path, depth)
+
+            fields = {name: record[name] for name in COMMENT_FIELDS
+                      if name not in ('id', 'post_id', 'parent_comment_id')}
+            comment = Comment(id=comment_id, post_id=post_id, parent_comment_id=parent and parent[0],
+                              root_id=root_id, path=path, depth=depth,
+                              author_id=authors[(record['user_name'], record['email'])], **fields)
+            # bulk_create skips save(); without a digest every text is sanitized here
+            comment.sanitize()
+            comments.append(comment)
+
+        with keep_timestamps():
+            Comment.objects.bulk_create(comments)
+        self.count += len(comments)
+
+
+def import_comment_records(records, post_map, keep_ids, batch_size, worker=0, workers=1):
+    # One worker's share of the comments: whole posts, picked by post id
+    importer = CommentImporter(post_map, keep_ids, batch_size)
+    for record in records:
+        if record['type'] == 'comment' and record['post_id'] % workers == worker:
+            importer.add(decode_datetimes(record))
+    importer.flush()
+    return importer.count
+
+
+def import_comment_file(path, fmt, post_map, keep_ids, batch_size, worker, workers):
+    # Entry point of a parallel import worker, which reads the file on its own
+    with open(path, 'rb') as stream:
+        return import_comment_records(read_records(stream, fmt), post_map, keep_ids, batch_size, worker, workers)
+
+
+def recount_authors():
+    # The directory counters of every author, from their comments
+    comments = Comment.objects.filter(author=OuterRef('pk')).order_by().values('author')
+    UserInfo.objects.update(
+        comment_count=Coalesce(Subquery(comments.annotate(count=Count('id')).values('count')), 0),
+        last_seen=Subquery(comments.annotate(last=Max('created_at')).values('last')),
+    )
@@ -0,0 +1,303 @@
+import math
+from datetime import timedelta
+from itertools import chain
+from operator import itemgetter
+
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, ParseError
+
+from .models import Comment
+from .pagination import decode_cursor, encode_cursor, keyset_filter
+from .serializers import COMMENT_VALUES, serialize_comment_rows
+
+
+COMMENTS_PAGE_SIZE = 25
+
+# Changes are read in (updated_at, id) order, at most this many per response
+SINCE_ORDERING = ['updated_at', 'id']
+COMMENTS_CHANGES_LIMIT = 100
+
+# updated_at is stamped by the app before the comment commits, so a comment with an earlier stamp
+# can become visible after a later one was already sent. Issued ?since= cursors therefore stay this
+# many seconds behind the clock and the changes in that window are sent again; clients apply them
+# by id. A commit slower than the window (or app servers whose clocks differ by more) can still be
+# missed until the next full page load
+COMMENTS_SINCE_OVERLAP = 5
+
+# With ?replies=N every node carries at most N children, down to this many levels below the root
+COMMENTS_MAX_INLINE_REPLIES = 50
+COMMENTS_INLINE_REPLY_DEPTH = 2
+
+# Sort keys accepted by the comments API mapped to model fields
+SORT_FIELDS = {
+    'user_name': 'user_name',
+    'email': 'email',
+    'date_added': 'created_at',
+}
+
+
+def get_comment_ordering(sort_by, order):
+    # Without a known sort key comments are shown LIFO; id keeps the order stable for equal values
+    field = SORT_FIELDS.get(sort_by)
+    if field is None:
+        return ['-created_at', '-id']
+    if order == 'desc':
+        return ['-' + field, '-id']
+    return [field, 'id']
+
+
+def get_root_comments(post):
+    return Comment.objects.filter(post=post, parent_comment__isnull=True).values(*COMMENT_VALUES)
+
+
+def get_page_number(page, count):
+    # Same rules as DRF's PageNumberPagination: 1-based, 'last' allowed, an empty first page is valid
+    num_pages = max(1, math.ceil(count / COMMENTS_PAGE_SIZE))
+    if page in (None, ''):
+        return 1, num_pages
+    if page == 'last':
+        return num_pages, num_pages
+    try:
+        number = int(page)
+    except ValueError:
+        raise NotFound('Invalid page.')
+    if not 1 <= number <= num_pages:
+        raise NotFound('Invalid page.')
+    return number, num_pages
+
+
+def get_page_slice(number):
+    offset = (number - 1) * COMMENTS_PAGE_SIZE
+    return slice(offset, offset + COMMENTS_PAGE_SIZE)
+
+
+def get_page_meta(ordering, roots, page, number, num_pages):
+    # The page count comes from root_count, which can drift above the real count until it is
+    # reconciled; a page inside the counted range can then be empty and is a 404 like any past the end
+    if not roots and number > 1:
+        raise NotFound('Invalid page.')
+    # A cursor to the next page lets the client continue in keyset mode
+    next_cursor = encode_cursor(ordering, roots[-1]) if number < num_pages and roots else None
+    return {
+        'page': page or 1,
+        'total_pages': num_pages,
+        'next_cursor': next_cursor,
+    }
+
+
+def get_cursor_meta(ordering, roots):
+    # One extra row tells whether there is a next page without counting
+    has_next = len(roots) > COMMENTS_PAGE_SIZE
+    roots = roots[:COMMENTS_PAGE_SIZE]
+    return roots, {
+        'next_cursor': encode_cursor(ordering, roots[-1]) if has_next else None,
+    }
+
+
+def get_cursor_page_queryset(post, ordering, cursor):
+    # Keyset pagination: every page is an index range scan, however deep it is
+    value, pk = decode_cursor(ordering, cursor)
+    return (get_root_comments(post).filter(keyset_filter(ordering, value, pk))
+            .order_by(*ordering)[:COMMENTS_PAGE_SIZE + 1])
+
+
+def paginate_root_comments(post, ordering, page):
+    # Only root comments are paginated, and the page is cut in the database; the page count
+    # comes from the post's root counter instead of a COUNT(*)
+    roots = get_root_comments(post).order_by(*ordering)
+    number, num_pages = get_page_number(page, post.root_count)
+    rows = list(roots[get_page_slice(number)])
+    return rows, get_page_meta(ordering, rows, page, number, num_pages)
+
+
+async def apaginate_root_comments(post, ordering, page):
+    roots = get_root_comments(post).order_by(*ordering)
+    number, num_pages = get_page_number(page, post.root_count)
+    rows = [row async for row in roots[get_page_slice(number)]]
+    return rows, get_page_meta(ordering, rows, page, number, num_pages)
+
+
+def paginate_root_comments_by_cursor(post, ordering, cursor):
+    return get_cursor_meta(ordering, list(get_cursor_page_queryset(post, ordering, cursor)))
+
+
+async def apaginate_root_comments_by_cursor(post, ordering, cursor):
+    rows = [row async for row in get_cursor_page_queryset(post, ordering, cursor)]
+    return get_cursor_meta(ordering, rows)
+
+
+def get_thread_replies(root_ids):
+    # All replies of the given threads come from one indexed query on the denormalized root
+    return Comment.objects.filter(root_id__in=root_ids, depth__gt=0).values(*COMMENT_VALUES)
+
+
+def load_descendants(root_ids, ordering):
+    return list(get_thread_replies(root_ids).order_by(*ordering))
+
+
+async def aload_descendants(root_ids, ordering):
+    return [row async for row in get_thread_replies(root_ids).order_by(*ordering)]
+
+
+def get_inline_replies(value):
+    # None keeps the full threads
+    if value in (None, ''):
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise ParseError('Invalid replies.')
+    return min(max(number, 0), COMMENTS_MAX_INLINE_REPLIES)
+
+
+def get_inline_replies_queryset(root_ids, ordering, limit):
+    # The first `limit` children of every node, ranked in the requested order within each parent
+    return (Comment.objects.filter(root_id__in=root_ids, depth__gt=0, depth__lte=COMMENTS_INLINE_REPLY_DEPTH)
+            .annotate(reply_rank=Window(RowNumber(), partition_by=[F('parent_comment_id')], order_by=ordering))
+            .filter(reply_rank__lte=limit).order_by(*ordering).values(*COMMENT_VALUES))
+
+
+def prune_inline_replies(roots, descendants):
+    # A reply whose parent was cut off by the limit can't be shown; parents always have a smaller depth
+    kept = {row['id'] for row in roots}
+    for row in sorted(descendants, key=itemgetter('depth')):
+        if row['parent_comment_id'] in kept:
+            kept.add(row['id'])
+    return [row for row in descendants if row['id'] in kept]
+
+
+def add_replies_cursors(nodes, descendants, ordering):
+    # Where "more replies" of a node continues: after its last inline child, or from the start
+    last_children = {row['parent_comment_id']: row for row in descendants}
+    for data in nodes:
+        last_child = last_children.get(data['id'])
+        data['replies_cursor'] = encode_cursor(ordering, last_child) if last_child else None
+
+
+def build_comment_tree(roots, descendants):
+    # Serialize every row once and attach children without recursion
+    roots = serialize_comment_rows(roots)
+    descendants = serialize_comment_rows(descendants)
+    nodes = {}
+    for data in chain(roots, descendants):
+        data['children'] = []
+        nodes[data['id']] = data
+
+    # Descendants are already sorted, so children keep the requested order
+    for data in descendants:
+        nodes[data['parent_comment']]['children'].append(data)
+
+    return roots
+
+
+def encode_since_cursor(row=None):
+    # The cursor never passes the start of the overlap window; without a row it is the window's start
+    horizon = timezone.now() - timedelta(seconds=COMMENTS_SINCE_OVERLAP)
+    if row is None or (row['updated_at'], row['id']) > (horizon, 0):
+        row = {'updated_at': horizon, 'id': 0}
+    return encode_cursor(SINCE_ORDERING, row)
+
+
+def iter_tree(nodes):
+    stack = list(nodes)
+    while stack:
+        data = stack.pop()
+        stack.extend(data['children'])
+        yield data
+
+
+def build_page_tree(roots, descendants, ordering, inline_replies):
+    tree = build_comment_tree(roots, descendants)
+    if inline_replies is not None:
+        add_replies_cursors(iter_tree(tree), descendants, ordering)
+    return tree
+
+
+def get_comment_page(post, params):
+    ordering = get_comment_ordering(params.get('sort_by'), params.get('order', 'asc'))
+    inline_replies = get_inline_replies(params.get('replies'))
+    cursor = params.get('cursor')
+    if cursor:
+        roots, meta = paginate_root_comments_by_cursor(post, ordering, cursor)
+    else:
+        roots, meta = paginate_root_comments(post, ordering, params.get('page'))
+    root_ids = [row['id'] for row in roots]
+    if inline_replies is None:
+        descendants = load_descendants(root_ids, ordering)
+    else:
+        rows = list(get_inline_replies_queryset(root_ids, ordering, inline_replies))
+        descendants = prune_inline_replies(roots, rows)
+    # Changes are followed from the time the page was read, whatever its comments
+    meta['since'] = encode_since_cursor()
+    return build_page_tree(roots, descendants, ordering, inline_replies), meta
+
+
+async def aget_comment_page(post, params):
+    ordering = get_comment_ordering(params.get('sort_by'), params.get('order', 'asc'))
+    inline_replies = get_inline_replies(params.get('replies'))
+    cursor = params.get('cursor')
+    if cursor:
+        roots, meta = await apaginate_root_comments_by_cursor(post, ordering, cursor)
+    else:
+        roots, meta = await apaginate_root_comments(post, ordering, params.get('page'))
+    root_ids = [row['id'] for row in roots]
+    if inline_replies is None:
+        descendants = await aload_descendants(root_ids, ordering)
+    else:
+        rows = [row async for row in get_inline_replies_queryset(root_ids, ordering, inline_replies)]
+        descendants = prune_inline_replies(roots, rows)
+    # Changes are followed from the time the page was read, whatever its comments
+    meta['since'] = encode_since_cursor()
+    return build_page_tree(roots, descendants, ordering, inline_replies), meta
+
+
+def get_comment_replies(comment_id, params):
+    # One level of replies, so deeper levels are only loaded when they are expanded
+    ordering = get_comment_ordering(params.get('sort_by'), params.get('order', 'asc'))
+    # Like every other read path, only comments of published posts are served
+    comments = Comment.objects.filter(post__status='published')
+    replies = comments.filter(parent_comment_id=comment_id).values(*COMMENT_VALUES)
+    cursor = params.get('cursor')
+    if cursor:
+        value, pk = decode_cursor(ordering, cursor)
+        replies = replies.filter(keyset_filter(ordering, value, pk))
+    rows, meta = get_cursor_meta(ordering, list(replies.order_by(*ordering)[:COMMENTS_PAGE_SIZE + 1]))
+    if not rows and not comments.filter(pk=comment_id).exists():
+        raise NotFound('Comment not found.')
+    comments = serialize_comment_rows(rows)
+    for data in comments:
+        data['children'] = []
+        data['replies_cursor'] = None
+    return comments, meta
+
+
+def get_changed_comments_queryset(post, since):
+    # Created and edited comments alike bump updated_at, so one range scan finds both
+    value, pk = decode_cursor(SINCE_ORDERING, since)
+    return (Comment.objects.filter(post=post).filter(keyset_filter(SINCE_ORDERING, value, pk))
+            .order_by(*SINCE_ORDERING).values(*COMMENT_VALUES)[:COMMENTS_CHANGES_LIMIT + 1])
+
+
+def get_changes_meta(rows, since):
+    # A flat list: every comment carries its parent id and is grafted by the client
+    has_more = len(rows) > COMMENTS_CHANGES_LIMIT
+    rows = rows[:COMMENTS_CHANGES_LIMIT]
+    if not rows:
+        next_since = since
+    elif has_more:
+        # The rest follows right away, so the cursor has to move past this batch
+        next_since = encode_cursor(SINCE_ORDERING, rows[-1])
+    else:
+        next_since = encode_since_cursor(rows[-1])
+    return serialize_comment_rows(rows), {'since': next_since, 'has_more': has_more}
+
+
+def get_comment_changes(post, since):
+    return get_changes_meta(list(get_changed_comments_queryset(post, since)), since)
+
+
+async def aget_comment_changes(post, since):
+    rows = [row async for row in get_changed_comments_queryset(post, since)]
+    return get_changes_meta(rows, since)
@@ -0,0 +1,108 @@
+from PIL import Image
+from django.conf import settings
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+
+# Leading bytes of the accepted image formats; the client's content type is not trusted
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+SNIFF_LENGTH = 16
+
+
+def sniff_image_type(head):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+class CommentUploadHandler(TemporaryFileUploadHandler):
+    # Streams comment attachments to temporary files and rejects them as soon as a limit is crossed
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.error = None
+        self.status = 400
+        self.limit = None
+        self.head = b''
+
+    def reject(self, message, status=400):
+        # The rest of the body is read and discarded, so the client still gets a proper response
+        self.error = message
+        self.status = status
+        raise StopUpload(connection_reset=False)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Under WSGI an oversize body is refused before a single byte of it is read. Under ASGI Django
+        # has already buffered the body by now, so RequestBodyLimitMiddleware refuses it earlier
+        if content_length > settings.COMMENTS_MAX_UPLOAD_SIZE:
+            self.error = 'Request is too large'
+            self.status = 413
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return super().handle_raw_input(input_data, META, content_length, boundary, encoding)
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None,
+                 content_type_extra=None):
+        if field_name == 'image':
+            self.limit = settings.COMMENTS_MAX_IMAGE_SIZE
+        elif field_name == 'file':
+            if not file_name.endswith('.txt'):
+                self.reject('Invalid file format. Only .txt files are allowed.')
+            self.limit = settings.COMMENTS_MAX_TEXT_FILE_SIZE
+        else:
+            self.reject(f'Unexpected file field: {field_name}')
+
+        if content_length is not None and content_length > self.limit:
+            self.reject('File is too large')
+        self.head = b''
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.limit:
+            self.reject('File is too large')
+        if len(self.head) < SNIFF_LENGTH:
+            self.head += raw_data[:SNIFF_LENGTH - len(self.head)]
+            if len(self.head) >= SNIFF_LENGTH:
+                self.check_head()
+        return super().receive_data_chunk(raw_data, start)
+
+    def check_head(self):
+        if self.field_name == 'image':
+            content_type = sniff_image_type(self.head)
+            if content_type is None:
+                self.reject('Invalid image format')
+            self.content_type = self.file.content_type = content_type
+        elif b'\x00' in self.head:
+            self.reject('Invalid file format. Only .txt files are allowed.')
+
+    def file_complete(self, file_size):
+        # Files shorter than the sniffing window are checked here
+        if len(self.head) < SNIFF_LENGTH:
+            self.check_head()
+        uploaded_file = super().file_complete(file_size)
+        if self.field_name == 'image':
+            self.check_pixels(uploaded_file)
+        return uploaded_file
+
+    def check_pixels(self, uploaded_file):
+        # Only the header is parsed here; pixel data is never decoded
+        try:
+            width, height = Image.open(uploaded_file).size
+        except Exception:
+            self.reject('Invalid image format')
+        if width * height > settings.COMMENTS_MAX_IMAGE_PIXELS:
+            self.reject('Image dimensions are too large')
+        uploaded_file.seek(0)
+
+
+def get_upload_error(request):
+    for handler in request.upload_handlers:
+        if getattr(handler, 'error', None):
+            return handler.error, handler.status
+    return None
@@ -6,10 +6,20 @@ app_name = 'user_comments'
 urlpatterns = [
     path('', views.PostListView.as_view(), name='post_list'),
     path('<int:year>/<int:month>/<int:day>/<int:post_id>/', views.PostDetailView.as_view(), name='post_detail'),
+    path('captcha/pool/<str:key>/', views.captcha_pool_image, name='captcha_pool_image'),
     path('captcha/', include('captcha.urls')),
     path('get_captcha/', views.get_captcha, name='get_captcha'),
     path('api/v1/comments/<int:year>/<int:month>/<int:day>/<int:post_id>/', views.CommentAPIView.as_view(),
          name='comment-list'),
     path('api/v1/comments/<int:year>/<int:month>/<int:day>/<int:post_id>/create/', views.CommentAPIView.as_view(),
          name='create-comment'),
+    path('api/v1/comments/search/', views.CommentSearchAPIView.as_view(), name='comment-search'),
+    path('api/v1/comments/<int:comment_id>/replies/', views.CommentRepliesAPIView.as_view(), name='comment-replies'),
+    path('api/v1/async/comments/<int:year>/<int:month>/<int:day>/<int:post_id>/',
+         views.AsyncCommentListView.as_view(), name='comment-list-async'),
+    path('api/v1/async/comments/<int:year>/<int:month>/<int:day>/<int:post_id>/create/',
+         views.AsyncCommentCreateView.as_view(), name='create-comment-async'),
+    path('api/v1/async/comments/<int:year>/<int:month>/<int:day>/<int:post_id>/events/',
+         views.CommentEventsView.as_view(), name='comment-events'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
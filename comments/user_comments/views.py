@@ -1,45 +1,53 @@
-import json
-from datetime import datetime
-from io import BytesIO
-
-from PIL import Image
-from bleach import clean
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models.functions import Substr
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.decorators import method_decorator
 from django.views import View
-from lxml import etree
-from rest_framework import pagination
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
+from .captcha_pool import get_captcha_pool_image, pop_captcha
+from .cache import (comment_body_cache_key, comment_page_etag, comment_representation_digest, get_cached_body,
+                    get_cached_comment_page, get_post_generation, get_posts_generation, post_list_cache_key,
+                    set_cached_body, set_cached_comment_page)
+from .compression import compress_body, get_accepted_encoding
+from .events import stream_post_events
 from .forms import CommentForm
-from .models import Post, Comment, UserInfo
+from .instrumentation import metrics, span
+from .models import Post
+from .ratelimit import get_client_ip
+from .search import search_comments
+from .renderers import MessagePackRenderer, accepts_msgpack
 from captcha.models import CaptchaStore
 from captcha.helpers import captcha_image_url
+from captcha.views import captcha_image
 
-from .serializers import CommentSerializer, PostSerializer
-
-
-# Set allowed tags and attributes for cleaning the text
-BLEACH_ALLOWED_TAGS = settings.BLEACH_ALLOWED_TAGS
-BLEACH_ALLOWED_ATTRIBUTES = settings.BLEACH_ALLOWED_ATTRIBUTES
-
-
-def save_user_info(user_name, email):
-    # Check if such a user exists in the database
-    user_info, created = UserInfo.objects.get_or_create(
-        user_name=user_name,
-        email=email
-    )
-    return user_info
+from .serializers import PostSerializer, flatten_comment_tree
+from .services import CommentError, check_rate_limit, create_comment, acreate_comment
+from .tree import get_comment_changes, aget_comment_changes, get_comment_page, aget_comment_page, get_comment_replies
+from .uploadhandlers import CommentUploadHandler, get_upload_error
 
 
 def get_captcha(request):
     if request.method == 'GET':
-        captcha = CaptchaStore.generate_key()
-        image_url = captcha_image_url(captcha)
+        # Pre-generated keys come with a stored image; an empty pool falls back to the on-demand path
+        captcha = pop_captcha()
+        if captcha is not None:
+            image_url = reverse('user_comments:captcha_pool_image', args=[captcha])
+        else:
+            captcha = CaptchaStore.generate_key()
+            image_url = captcha_image_url(captcha)
         request.session['expected_captcha'] = captcha
         response_data = {
             'key': captcha,
@@ -48,188 +56,291 @@ def get_captcha(request):
         return JsonResponse(response_data)
 
 
+def captcha_pool_image(request, key):
+    image = get_captcha_pool_image(key)
+    if image is None:
+        return captcha_image(request, key)
+    return HttpResponse(image, content_type='image/png')
+
+
+def get_comment_page_payload(post, comments, meta):
+    # Serialize post and attach the page of comments
+    post_serializer = PostSerializer(post)
+    result = {
+        'post': post_serializer.data,
+        'comments': comments,
+    }
+    result.update(meta)
+    return result
+
+
+def apply_comment_layout(result, params):
+    # ?layout=columns sends the tree as flat columns; cached payloads always keep the nested form
+    if params.get('layout') == 'columns':
+        return {**result, 'comments': flatten_comment_tree(result['comments'])}
+    return result
+
+
+def comment_api_response(request, result):
+    response = Response(apply_comment_layout(result, request.GET))
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def comment_error_response(error):
+    response = JsonResponse({'success': False, 'message': error.message}, status=error.status)
+    if error.retry_after:
+        response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+# Characters of the body read for the listing excerpt, enough for its 30 words
+POST_EXCERPT_LENGTH = 400
+
+# Formats whose bodies are cached compressed, next to the page payload
+PRECOMPRESSED_FORMATS = ('json', 'msgpack')
+
+
+def get_comment_validators(request, post_id, encoding):
+    # Only the cache is read, so conditional GETs are answered before any query
+    generation = get_post_generation(post_id)
+    digest = comment_representation_digest(request)
+    return generation, digest, comment_page_etag(post_id, generation, digest, encoding)
+
+
+def finish_comment_response(response, etag):
+    response['ETag'] = etag
+    # Browsers keep the body but revalidate it on every poll
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Accept', 'Accept-Encoding'])
+    return response
+
+
+def get_not_modified_response(request, etag):
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return finish_comment_response(response, etag)
+
+
+def compressed_response(body, media_type, encoding, etag):
+    response = HttpResponse(body, content_type=media_type)
+    response['Content-Encoding'] = encoding
+    return finish_comment_response(response, etag)
+
+
 class CommentAPIView(APIView):
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
+
     # GET method to retrieve comments for a post
     def get(self, request, year, month, day, post_id):
+        renderer, media_type = request.accepted_renderer, request.accepted_media_type
+        encoding = get_accepted_encoding(request) if renderer.format in PRECOMPRESSED_FORMATS else None
+        generation, digest, etag = get_comment_validators(request, post_id, encoding)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        # A repeated GET of the same representation is a single cache read
+        if encoding:
+            body_key = comment_body_cache_key(post_id, generation, digest, encoding)
+            body = get_cached_body(body_key)
+            if body is not None:
+                return compressed_response(body, media_type, encoding, etag)
+
         post = get_object_or_404(Post, id=post_id, status='published', publish__year=year, publish__month=month,
                                  publish__day=day)
 
-        # Extract sorting and ordering parameters
-        sort_by = request.GET.get('sort_by')
-        order = request.GET.get('order', 'asc')
-
-        # Choose sorting based on sort_by parameter
-        if sort_by == 'user_name':
-            if order == 'desc':
-                comments = Comment.objects.filter(post=post).order_by('-user_name')
-            else:
-                comments = Comment.objects.filter(post=post).order_by('user_name')
-        elif sort_by == 'email':
-            if order == 'desc':
-                comments = Comment.objects.filter(post=post).order_by('-email')
-            else:
-                comments = Comment.objects.filter(post=post).order_by('email')
-        elif sort_by == 'date_added':
-            if order == 'desc':
-                comments = Comment.objects.filter(post=post).order_by('-created_at')
-            else:
-                comments = Comment.objects.filter(post=post).order_by('created_at')
-        else:
-            comments = Comment.objects.filter(post=post).select_related('post', 'parent_comment').order_by(
-                '-created_at')
-
-        # Convert comments to a dictionary
-        comments_dict = {comment.id: CommentSerializer(comment).data for comment in comments}
-
-        # Group child comments according to parent comments
-        parent_to_children = {}
-        for comment in comments_dict.values():
-            comment['created_at'] = datetime.strptime(comment['created_at'], "%Y-%m-%dT%H:%M:%S.%fZ").strftime(
-                "%H:%M %d.%m.%Y")
-            parent_comment = comment.get('parent_comment')
-            if parent_comment:
-                parent_id = parent_comment
-                parent_to_children.setdefault(parent_id, []).append(comment)
-
-        # Select root comments and add child comments to them
-        root_comments = [comment for comment in comments_dict.values() if not comment.get('parent_comment')]
-
-        def add_children_to_parent(comment):
-            children = parent_to_children.get(comment['id'], [])
-            comment['children'] = children
-            for child in children:
-                add_children_to_parent(child)
-
-        for comment in root_comments:
-            add_children_to_parent(comment)
-
-        # Pagination of the results
-        paginator = pagination.PageNumberPagination()
-        paginator.page_size = 25
-        page = paginator.paginate_queryset(root_comments, request)
-
-        # Serialize post and return the result
-        post_serializer = PostSerializer(post)
-        result = {
-            'post': post_serializer.data,
-            'comments': page,
-            'page': request.GET.get('page', 1),
-            'total_pages': paginator.page.paginator.num_pages,
-        }
-        return Response(result)
+        # Serve the page from cache while the post's comments are unchanged
+        cache_key, result = get_cached_comment_page(post.id, generation, request.GET)
+        if result is None:
+            since = request.GET.get('since')
+            with span('page'):
+                if since:
+                    # Only the comments changed after the cursor, without the post
+                    comments, meta = get_comment_changes(post, since)
+                    result = {'comments': comments, **meta}
+                else:
+                    # Paginate root comments first (by page number or by cursor) and load only the threads of this page
+                    page, meta = get_comment_page(post, request.GET)
+                    result = get_comment_page_payload(post, page, meta)
+            set_cached_comment_page(cache_key, result)
+
+        result = apply_comment_layout(result, request.GET)
+        if encoding:
+            with span('render'):
+                body = compress_body(renderer.render(result, media_type, self.get_renderer_context()), encoding)
+            set_cached_body(body_key, body)
+            return compressed_response(body, media_type, encoding, etag)
+        return finish_comment_response(Response(result), etag)
+
+    def initialize_request(self, request, *args, **kwargs):
+        # Attachments are checked while they stream in, before the body is parsed
+        if request.method == 'POST':
+            request.upload_handlers = [CommentUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
 
     # POST method to create a new comment
     def post(self, request, year, month, day, post_id):
-        if request.method != 'POST':
-            return JsonResponse({'success': False, 'message': 'Method not supported'}, status=405)
         try:
-            data = request.data
-            print(data)
-            c_key = data.get('captcha_key', '')
-            captcha_stores = CaptchaStore.objects.filter(hashkey=c_key)
-            captcha_store = captcha_stores.first()
-            c_value = data.get('captcha_value', '')
-            print(c_key + ' value: ' + c_value + ' expected: ' + captcha_store.response)
-        except json.JSONDecodeError:
-            return JsonResponse({'success': False, 'message': 'Error parsing JSON'}, status=400)
-
-        # Create a comment form
-        form = CommentForm(data, request.FILES)
-
-        if form.is_valid():
-            # CAPTCHA validation
-            if captcha_store.response != c_value:
-                return JsonResponse({'success': False, 'message': 'Incorrect CAPTCHA'}, status=400)
-
-            parent_id = data.get('parent_comment')
-            post = get_object_or_404(Post, id=post_id)
-            parent_comment = get_object_or_404(Comment, id=parent_id) if parent_id else None
-
-            comment = form.save(commit=False)
-            comment.post = post
-            comment.parent_comment = parent_comment
-
-            # Add a CAPTCHA value to the comment
-            comment.captcha = c_value
-
-            # Clean the comment text from unwanted tags
-            cleaned_text = clean(comment.text, tags=BLEACH_ALLOWED_TAGS, attributes=BLEACH_ALLOWED_ATTRIBUTES)
-            comment.text = cleaned_text
-
-            # Validate XHTML markup
-            if not validate_xhtml(comment.text):
-                return JsonResponse({'success': False, 'message': 'Invalid XHTML markup'}, status=400)
-
-            # Handle image processing
-            try:
-                image_tmp_file = request.FILES.get('image')
-                if image_tmp_file:
+            # Bursts from one address are dropped before the body is even read
+            check_rate_limit('ip', get_client_ip(request))
 
-                    valid_formats = ['image/jpeg', 'image/png', 'image/gif']
-                    if image_tmp_file.content_type not in valid_formats:
-                        return JsonResponse({'success': False, 'message': 'Invalid image format'},
-                                            status=400)
+            # Parsing streams the attachments through the upload handler checks
+            with span('parse'):
+                data = request.data
+            upload_error = get_upload_error(request)
+            if upload_error:
+                message, status = upload_error
+                return JsonResponse({'success': False, 'message': message}, status=status)
 
-                    img = Image.open(image_tmp_file)
-                    width, height = img.size
-                    max_size = (320, 240)
-                    if width > max_size[0] or height > max_size[1]:
-                        img = img.resize(max_size)
-                        output_buffer = BytesIO()
+            comment = create_comment(data, request.FILES, post_id)
+        except CommentError as e:
+            return comment_error_response(e)
+        return JsonResponse({'success': True, 'comment_id': comment.id})
 
-                        img.save(output_buffer, format=image_tmp_file.content_type.split('/')[-1].upper())
 
-                        image_tmp_file = InMemoryUploadedFile(output_buffer, 'ImageField', f'{image_tmp_file.name}',
-                                                              image_tmp_file.content_type, output_buffer.tell, None)
+class CommentRepliesAPIView(APIView):
+    # Direct replies of one comment, a page at a time, for threads expanded on demand
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
 
-                    comment.image = image_tmp_file
+    def get(self, request, comment_id):
+        comments, meta = get_comment_replies(comment_id, request.GET)
+        return comment_api_response(request, {'comments': comments, **meta})
 
-            except Exception as e:
-                print(f"Error saving image: {e}")
 
-            # Handle text file processing
-            try:
-                file_tmp_file = request.FILES.get('file')
-                if file_tmp_file:
-                    if not file_tmp_file.name.endswith('.txt'):
-                        return JsonResponse(
-                            {'success': False, 'message': 'Invalid file format. Only .txt files are allowed.'},
-                            status=400)
-                    if file_tmp_file.size > 102400:  # 100 KB
-                        return JsonResponse({'success': False, 'message': 'File is too large'}, status=400)
-
-                    comment.text_file = file_tmp_file
-                    new_name = comment.text_file.name.split('/')[-1]
-                    comment.text_file.name = new_name
-            except Exception as e:
-                print(f"Error saving file: {e}")
-
-            # Save user information before saving the comment
-            save_user_info(comment.user_name, comment.email)
-
-            comment.save()
-            return JsonResponse({'success': True, 'comment_id': comment.id})
-        else:
-            errors = form.errors.as_json()
-            errors_dict = json.loads(errors)  # Convert JSON string to a dictionary
+class CommentSearchAPIView(APIView):
+    # Ranked full-text hits across published posts, each with the start of its thread
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
 
-            # Check if the 'image' key is in the dictionary
-            if "image" in errors_dict:
-                message = errors_dict["image"][0]["message"]
-            else:
-                # If the 'image' field has no errors, display a general message or another field
-                message = list(errors_dict.values())[0][0][
-                    "message"]  # Get the message from the first field with an error
+    def get(self, request):
+        response = Response(search_comments(request.GET))
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class AsyncCommentListView(View):
+    # Async twin of CommentAPIView.get for ASGI workers
+    async def get(self, request, year, month, day, post_id):
+        renderer = MessagePackRenderer() if accepts_msgpack(request) else JSONRenderer()
+        encoding = get_accepted_encoding(request)
+        generation, digest, etag = await sync_to_async(get_comment_validators)(request, post_id, encoding)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        if encoding:
+            body_key = comment_body_cache_key(post_id, generation, digest, encoding)
+            body = await sync_to_async(get_cached_body)(body_key)
+            if body is not None:
+                return compressed_response(body, renderer.media_type, encoding, etag)
+
+        try:
+            post = await Post.objects.aget(id=post_id, status='published', publish__year=year,
+                                           publish__month=month, publish__day=day)
+        except Post.DoesNotExist:
+            return JsonResponse({'detail': 'No Post matches the given query.'}, status=404)
+
+        cache_key, result = await sync_to_async(get_cached_comment_page)(post.id, generation, request.GET)
+        if result is None:
+            since = request.GET.get('since')
+            try:
+                with span('page'):
+                    if since:
+                        comments, meta = await aget_comment_changes(post, since)
+                        result = {'comments': comments, **meta}
+                    else:
+                        page, meta = await aget_comment_page(post, request.GET)
+                        result = get_comment_page_payload(post, page, meta)
+            except APIException as e:
+                return JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+            await sync_to_async(set_cached_comment_page)(cache_key, result)
+
+        with span('render'):
+            body = renderer.render(apply_comment_layout(result, request.GET))
+            if encoding:
+                body = compress_body(body, encoding)
+        if encoding:
+            await sync_to_async(set_cached_body)(body_key, body)
+            return compressed_response(body, renderer.media_type, encoding, etag)
+        return finish_comment_response(HttpResponse(body, content_type=renderer.media_type), etag)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncCommentCreateView(View):
+    # Async twin of CommentAPIView.post for ASGI workers. The CSRF check reads request.POST, so the
+    # middleware is skipped and the check runs through csrf_protect once the upload handler is installed
+    async def post(self, request, year, month, day, post_id):
+        try:
+            await sync_to_async(check_rate_limit)('ip', get_client_ip(request))
+        except CommentError as e:
+            return comment_error_response(e)
+
+        # The body is already buffered by the ASGI handler; multipart parsing is offloaded to a thread
+        request.upload_handlers = [CommentUploadHandler(request)]
+        with span('parse'):
+            await sync_to_async(lambda: (request.POST, request.FILES), thread_sensitive=False)()
+        return await csrf_protect(self.create)(request, post_id)
+
+    async def create(self, request, post_id):
+        upload_error = get_upload_error(request)
+        if upload_error:
+            message, status = upload_error
+            return JsonResponse({'success': False, 'message': message}, status=status)
 
-            return JsonResponse({'success': False, 'message': message}, status=400)
+        try:
+            comment = await acreate_comment(request.POST, request.FILES, post_id)
+        except CommentError as e:
+            return comment_error_response(e)
+        return JsonResponse({'success': True, 'comment_id': comment.id})
+
+
+class CommentEventsView(View):
+    # Server-sent events with the comments added to a post while its page is open
+    async def get(self, request, year, month, day, post_id):
+        if not await Post.objects.filter(id=post_id, status='published', publish__year=year,
+                                         publish__month=month, publish__day=day).aexists():
+            return JsonResponse({'detail': 'No Post matches the given query.'}, status=404)
+
+        response = StreamingHttpResponse(stream_post_events(post_id), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def render_post_list(page_number):
+    # Only what the listing shows: no full bodies, the author in the same query, published posts only
+    posts = (Post.objects.filter(status='published').select_related('author')
+             .only('id', 'title', 'publish', 'comment_count', 'author__username')
+             .annotate(excerpt=Substr('body', 1, POST_EXCERPT_LENGTH)))
+    paginator = Paginator(posts, settings.COMMENTS_POSTS_PER_PAGE)
+    try:
+        page = paginator.page(page_number)
+    except InvalidPage:
+        raise Http404('Invalid page')
+    return render_to_string('user_comments/post_list.html', {'page': page})
 
 
 class PostListView(View):
     def get(self, request):
-        posts = Post.objects.all()
-        for post in posts:
-            post.formatted_date = post.publish.strftime('%Y/%m/%d')
-        return render(request, 'user_comments/index.html', {'posts': posts})
+        # The listing changes only with the posts, so unchanged ones are answered without a query
+        generation = get_posts_generation()
+        etag = f'"posts-{generation}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            page_number = request.GET.get('page', '1')
+            if not page_number.isdigit():
+                raise Http404('Invalid page')
+
+            # The rendered listing is shared by everyone; the page around it carries the user's CSRF token
+            key = post_list_cache_key(generation, int(page_number))
+            post_list = cache.get(key)
+            if post_list is None:
+                post_list = render_post_list(int(page_number))
+                cache.set(key, post_list, settings.COMMENTS_CACHE_TIMEOUT)
+            response = render(request, 'user_comments/index.html', {'post_list': post_list})
+        response['ETag'] = etag
+        return response
 
 
 class PostDetailView(View):
@@ -246,10 +357,8 @@ class PostDetailView(View):
         })
 
 
-# Function for validating XHTML markup
-def validate_xhtml(text):
-    try:
-        etree.fromstring("<root>" + text + "</root>")
-        return True
-    except etree.XMLSyntaxError:
-        return False
+def metrics_view(request):
+    # Prometheus scrape target of this worker process; off unless COMMENTS_METRICS is set
+    if not settings.COMMENTS_METRICS:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')